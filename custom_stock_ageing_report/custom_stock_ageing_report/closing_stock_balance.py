@@ -0,0 +1,178 @@
+# Copyright (c) 2024, sushant and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.utils import add_days, add_months, get_first_day, get_last_day, getdate, today
+
+from custom_stock_ageing_report.custom_stock_ageing_report.doctype.closing_stock_balance_entry.closing_stock_balance_entry import (
+	index_closing_stock_balance,
+)
+
+# filters of a Closing Stock Balance, monthly closings are company wide and leave them empty
+CLOSING_FILTER_FIELDS = ("warehouse", "item_code", "item_group", "warehouse_type")
+
+# closings still being prepared, not closed again unless untouched for this many days
+PENDING_CLOSING_STATUSES = ("Queued", "In Progress")
+PENDING_CLOSING_DAYS = 1
+
+
+def create_monthly_closing_stock_balances():
+	"""
+	Daily job, close every month up to the previous one for each company.
+
+	Closings cancelled by a back-dated change are recreated here, so the stock balance
+	report always finds a closing at most a month old to start its ledger scan from.
+	Closings prepared since the last run are indexed for the report. A month that fails is
+	logged and retried by the next run, the other months and companies are still closed.
+	"""
+	for company in frappe.get_all("Company", pluck="name"):
+		for month_end in get_unclosed_month_ends(company):
+			try:
+				create_closing_stock_balance(company, month_end)
+				frappe.db.commit()
+			except Exception:
+				frappe.db.rollback()
+				frappe.log_error(title=f"Monthly Closing Stock Balance failed for {company} ({month_end})")
+
+		filters = get_company_closing_filters(company)
+		filters["status"] = "Completed"
+		for name in frappe.get_all("Closing Stock Balance", filters=filters, pluck="name"):
+			try:
+				index_closing_stock_balance(name)
+				frappe.db.commit()
+			except Exception:
+				frappe.db.rollback()
+				frappe.log_error(title=f"Indexing Closing Stock Balance {name} failed")
+
+
+def get_unclosed_month_ends(company: str):
+	"""
+	Month ends since the first ledger entry of `company` without a company wide closing that
+	completed or is still being prepared. Failed closings and those stuck in the queue are
+	closed again.
+	"""
+	first_posting_date = frappe.db.get_value(
+		"Stock Ledger Entry",
+		{"company": company, "is_cancelled": 0},
+		"min(posting_date)",
+	)
+	if not first_posting_date:
+		return []
+
+	pending_since = getdate(add_days(today(), -PENDING_CLOSING_DAYS))
+	closed = {
+		getdate(d.to_date)
+		for d in frappe.get_all(
+			"Closing Stock Balance",
+			filters=get_company_closing_filters(company),
+			fields=["to_date", "status", "modified"],
+		)
+		if d.status == "Completed"
+		or (d.status in PENDING_CLOSING_STATUSES and getdate(d.modified) >= pending_since)
+	}
+
+	month_end = get_last_day(first_posting_date)
+	last_month_end = get_last_day(add_months(today(), -1))
+
+	month_ends = []
+	while month_end <= last_month_end:
+		if month_end not in closed:
+			month_ends.append(month_end)
+		month_end = get_last_day(add_days(month_end, 1))
+
+	return month_ends
+
+
+def create_closing_stock_balance(company: str, month_end):
+	"""
+	Submitting the closing queues the preparation of its balances. A failed or stuck closing
+	of the month is cancelled first, it would overlap the new one.
+	"""
+	filters = get_company_closing_filters(company)
+	filters["to_date"] = month_end
+	cancel_closings(frappe.get_all("Closing Stock Balance", filters=filters, pluck="name"))
+
+	doc = frappe.get_doc(
+		{
+			"doctype": "Closing Stock Balance",
+			"company": company,
+			"from_date": get_first_day(month_end),
+			"to_date": month_end,
+		}
+	)
+	doc.flags.ignore_permissions = True
+	doc.insert()
+	doc.submit()
+
+
+def invalidate_closing_stock_balances(company: str, posting_date):
+	"""
+	Cancel monthly closings on or after a back-dated change, the daily job closes those months again.
+
+	Runs for every ledger entry submitted, so only the lookup runs in the posting transaction,
+	the cancellation is queued once per company and date after it commits.
+	"""
+	if not company or not posting_date or getdate(posting_date) >= get_first_day(today()):
+		return
+
+	posting_date = getdate(posting_date)
+	invalidated = frappe.flags.setdefault("invalidated_closing_stock_balances", set())
+	if (company, posting_date) in invalidated:
+		return
+
+	invalidated.add((company, posting_date))
+	filters = get_company_closing_filters(company)
+	filters["to_date"] = (">=", posting_date)
+	if not frappe.db.exists("Closing Stock Balance", filters):
+		return
+
+	frappe.enqueue(
+		cancel_closing_stock_balances,
+		queue="long",
+		job_id=f"cancel_closing_stock_balances::{company}::{posting_date}",
+		deduplicate=True,
+		enqueue_after_commit=True,
+		company=company,
+		from_date=posting_date,
+	)
+
+
+def cancel_closing_stock_balances(company: str, from_date):
+	"Cancel the monthly closings of `company` closing on or after `from_date`."
+	filters = get_company_closing_filters(company)
+	filters["to_date"] = (">=", from_date)
+
+	cancel_closings(frappe.get_all("Closing Stock Balance", filters=filters, pluck="name"))
+
+
+def cancel_closings(names):
+	for name in names:
+		doc = frappe.get_doc("Closing Stock Balance", name)
+		doc.flags.ignore_permissions = True
+		doc.cancel()
+
+
+def get_company_closing_filters(company: str):
+	filters = {"company": company, "docstatus": 1}
+	for fieldname in CLOSING_FILTER_FIELDS:
+		filters[fieldname] = ("is", "not set")
+
+	return filters
+
+
+def on_stock_ledger_entry_submit(doc, method=None):
+	invalidate_closing_stock_balances(doc.company, doc.posting_date)
+
+
+def on_repost_item_valuation_submit(doc, method=None):
+	invalidate_closing_stock_balances(doc.company, doc.posting_date)
+
+
+def on_cancel(doc, method=None):
+	"Cancelled stock vouchers reverse their ledger entries as of the original posting date."
+	company, posting_date = doc.get("company"), doc.get("posting_date")
+	if not company or not posting_date or getdate(posting_date) >= get_first_day(today()):
+		return
+
+	if frappe.db.exists("Stock Ledger Entry", {"voucher_type": doc.doctype, "voucher_no": doc.name}):
+		invalidate_closing_stock_balances(company, posting_date)
@@ -0,0 +1,107 @@
+# Copyright (c) 2024, sushant and contributors
+# For license information, please see license.txt
+
+import json
+
+import frappe
+from frappe.model.document import Document
+from frappe.utils import flt, now
+
+from erpnext.stock.doctype.inventory_dimension.inventory_dimension import get_inventory_dimensions
+
+ENTRY_FIELDS = (
+	"name",
+	"creation",
+	"modified",
+	"owner",
+	"modified_by",
+	"closing_stock_balance",
+	"company",
+	"item_code",
+	"warehouse",
+	"item_group",
+	"bal_qty",
+	"bal_val",
+	"fifo_queue",
+	"inventory_dimensions",
+)
+
+
+class ClosingStockBalanceEntry(Document):
+	pass
+
+
+def on_doctype_update():
+	frappe.db.add_index("Closing Stock Balance Entry", ["closing_stock_balance", "item_code", "warehouse"])
+	frappe.db.add_index("Closing Stock Balance Entry", ["closing_stock_balance", "warehouse"])
+
+
+def index_closing_stock_balance(closing_stock_balance: str):
+	"""
+	Store the prepared data of a Closing Stock Balance as one row per entry, so that
+	reports read the (item, warehouse) slice they need instead of the whole file.
+	Does nothing if the closing is already indexed.
+
+	Runs in background jobs only, the closing row is locked so that concurrent jobs
+	index it once.
+	"""
+	if not frappe.db.get_value("Closing Stock Balance", closing_stock_balance, "name", for_update=True):
+		return
+
+	if is_closing_stock_balance_indexed(closing_stock_balance):
+		return
+
+	res = frappe.get_doc("Closing Stock Balance", closing_stock_balance).get_prepared_data()
+	dimension_fields = [dimension.fieldname for dimension in get_inventory_dimensions()]
+
+	timestamp, user = now(), frappe.session.user
+	rows = []
+	for entry in res.data:
+		if not entry.get("item_code") or not entry.get("warehouse"):
+			continue
+
+		rows.append(
+			(
+				frappe.generate_hash(length=10),
+				timestamp,
+				timestamp,
+				user,
+				user,
+				closing_stock_balance,
+				entry.get("company"),
+				entry.get("item_code"),
+				entry.get("warehouse"),
+				entry.get("item_group"),
+				flt(entry.get("bal_qty")),
+				flt(entry.get("bal_val")),
+				json.dumps(entry.get("fifo_queue") or [], default=str, separators=(",", ":")),
+				json.dumps(
+					{fieldname: entry.get(fieldname) for fieldname in dimension_fields if entry.get(fieldname)},
+					separators=(",", ":"),
+				),
+			)
+		)
+
+	frappe.db.bulk_insert("Closing Stock Balance Entry", ENTRY_FIELDS, rows, chunk_size=5000)
+
+
+def is_closing_stock_balance_indexed(closing_stock_balance: str) -> bool:
+	return bool(
+		frappe.db.exists("Closing Stock Balance Entry", {"closing_stock_balance": closing_stock_balance})
+	)
+
+
+def queue_closing_stock_balance_index(closing_stock_balance: str):
+	frappe.enqueue(
+		index_closing_stock_balance,
+		queue="long",
+		job_id=f"index_closing_stock_balance::{closing_stock_balance}",
+		deduplicate=True,
+		enqueue_after_commit=True,
+		closing_stock_balance=closing_stock_balance,
+	)
+
+
+def delete_closing_stock_balance_entries(doc, method=None):
+	"Closing Stock Balance on_cancel and on_trash."
+	frappe.db.delete("Closing Stock Balance Entry", {"closing_stock_balance": doc.name})
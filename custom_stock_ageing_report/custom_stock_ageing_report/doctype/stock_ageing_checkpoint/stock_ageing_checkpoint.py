@@ -0,0 +1,199 @@
+# Copyright (c) 2024, sushant and contributors
+# For license information, please see license.txt
+
+import json
+
+import frappe
+from frappe.model.document import Document
+from frappe.utils import add_days, get_last_day, getdate, now, today
+
+from custom_stock_ageing_report.custom_stock_ageing_report.doctype.stock_ageing_snapshot.stock_ageing_snapshot import (
+	delete_stock_ageing_snapshots,
+)
+from custom_stock_ageing_report.custom_stock_ageing_report.report.custom_stock_ageing.custom_stock_ageing import (
+	FIFOSlots,
+	is_ledger_changed_since,
+)
+
+QUEUE_FIELDS = (
+	"name",
+	"creation",
+	"modified",
+	"owner",
+	"modified_by",
+	"checkpoint",
+	"item_code",
+	"warehouse",
+	"qty_after_transaction",
+	"total_qty",
+	"fifo_queue",
+)
+
+
+class StockAgeingCheckpoint(Document):
+	def on_trash(self):
+		frappe.db.delete("Stock Ageing Checkpoint Queue", {"checkpoint": self.name})
+
+
+def create_stock_ageing_checkpoints():
+	"Daily job, checkpoint FIFO Queues of each company as of yesterday."
+	checkpoint_date = getdate(add_days(today(), -1))
+
+	for company in frappe.get_all("Company", pluck="name"):
+		create_stock_ageing_checkpoint(company, checkpoint_date)
+		delete_superseded_checkpoints(company, checkpoint_date)
+		frappe.db.commit()
+
+
+def create_stock_ageing_checkpoint(company: str, checkpoint_date):
+	"""
+	Replay the ledger up to `checkpoint_date` and store the resulting FIFO Queues.
+
+	The replay itself starts from the previous checkpoint, so the job only reads the
+	entries posted since. Transfer buckets are not stored: they only live for the
+	posting date being replayed and are always empty at a day boundary.
+
+	Nothing is stored if an entry up to `checkpoint_date` is posted or cancelled during
+	the replay, the next run checkpoints again.
+	"""
+	if frappe.db.exists("Stock Ageing Checkpoint", {"company": company, "checkpoint_date": checkpoint_date}):
+		return
+
+	# batch items are replayed too, snapshots of the ageing trend replay them from the checkpoint
+	fifo_slots = FIFOSlots(
+		frappe._dict(
+			company=company,
+			to_date=checkpoint_date,
+			show_warehouse_wise_stock=True,
+			replay_batch_items=True,
+		)
+	)
+	started = now()
+	item_details = fifo_slots.generate()
+	if is_ledger_changed_since(company, checkpoint_date, started):
+		# back-dated entry posted while replaying, its invalidation may already have run
+		return
+
+	checkpoint = frappe.get_doc(
+		{
+			"doctype": "Stock Ageing Checkpoint",
+			"company": company,
+			"checkpoint_date": checkpoint_date,
+			"serial_no_purchase_dates": json.dumps(
+				fifo_slots.serial_no_batch_purchase_details, default=str, separators=(",", ":")
+			),
+		}
+	).insert(ignore_permissions=True)
+
+	timestamp, user = now(), frappe.session.user
+	rows = []
+	for (item_code, warehouse), item_dict in item_details.items():
+		if not item_dict["fifo_queue"] and not item_dict.get("qty_after_transaction"):
+			continue
+
+		rows.append(
+			(
+				frappe.generate_hash(length=10),
+				timestamp,
+				timestamp,
+				user,
+				user,
+				checkpoint.name,
+				item_code,
+				warehouse,
+				item_dict.get("qty_after_transaction"),
+				item_dict.get("total_qty"),
+				json.dumps(
+					[[slot.qty, str(slot.posting_date)] for slot in item_dict["fifo_queue"]],
+					separators=(",", ":"),
+				),
+			)
+		)
+
+	frappe.db.bulk_insert("Stock Ageing Checkpoint Queue", QUEUE_FIELDS, rows, chunk_size=5000)
+
+
+def delete_superseded_checkpoints(company: str, checkpoint_date):
+	"Keep month end checkpoints and the latest one, older daily checkpoints are not read again."
+	checkpoints = frappe.get_all(
+		"Stock Ageing Checkpoint",
+		filters={"company": company, "checkpoint_date": ("<", checkpoint_date)},
+		fields=["name", "checkpoint_date"],
+	)
+
+	delete_checkpoints(
+		[d.name for d in checkpoints if getdate(d.checkpoint_date) != get_last_day(d.checkpoint_date)]
+	)
+
+
+def invalidate_stock_ageing_checkpoints(company: str, posting_date):
+	"""
+	FIFO Queues of checkpoints (and ageing snapshots) on or after a back-dated change no longer hold.
+
+	Runs for every ledger entry submitted, so only the lookup runs in the posting transaction,
+	the deletion is queued once per company and date after it commits.
+	"""
+	if not company or not posting_date or getdate(posting_date) >= getdate(today()):
+		return
+
+	posting_date = getdate(posting_date)
+	invalidated = frappe.flags.setdefault("invalidated_stock_ageing_checkpoints", set())
+	if (company, posting_date) in invalidated:
+		return
+
+	invalidated.add((company, posting_date))
+	if not frappe.db.exists(
+		"Stock Ageing Checkpoint", {"company": company, "checkpoint_date": (">=", posting_date)}
+	) and not frappe.db.exists(
+		"Stock Ageing Snapshot", {"company": company, "snapshot_date": (">=", posting_date)}
+	):
+		return
+
+	frappe.enqueue(
+		delete_stock_ageing_checkpoints,
+		queue="long",
+		job_id=f"delete_stock_ageing_checkpoints::{company}::{posting_date}",
+		deduplicate=True,
+		enqueue_after_commit=True,
+		company=company,
+		from_date=posting_date,
+	)
+
+
+def delete_stock_ageing_checkpoints(company: str, from_date):
+	"Delete checkpoints and ageing snapshots on or after `from_date`."
+	delete_stock_ageing_snapshots(company, from_date)
+
+	delete_checkpoints(
+		frappe.get_all(
+			"Stock Ageing Checkpoint",
+			filters={"company": company, "checkpoint_date": (">=", from_date)},
+			pluck="name",
+		)
+	)
+
+
+def delete_checkpoints(names):
+	if not names:
+		return
+
+	frappe.db.delete("Stock Ageing Checkpoint Queue", {"checkpoint": ("in", names)})
+	frappe.db.delete("Stock Ageing Checkpoint", {"name": ("in", names)})
+
+
+def on_stock_ledger_entry_submit(doc, method=None):
+	invalidate_stock_ageing_checkpoints(doc.company, doc.posting_date)
+
+
+def on_repost_item_valuation_submit(doc, method=None):
+	invalidate_stock_ageing_checkpoints(doc.company, doc.posting_date)
+
+
+def on_cancel(doc, method=None):
+	"Cancelled stock vouchers reverse their ledger entries as of the original posting date."
+	company, posting_date = doc.get("company"), doc.get("posting_date")
+	if not company or not posting_date or getdate(posting_date) >= getdate(today()):
+		return
+
+	if frappe.db.exists("Stock Ledger Entry", {"voucher_type": doc.doctype, "voucher_no": doc.name}):
+		invalidate_stock_ageing_checkpoints(company, posting_date)
@@ -0,0 +1,149 @@
+# Copyright (c) 2024, sushant and contributors
+# For license information, please see license.txt
+
+import json
+
+import frappe
+from frappe.model.document import Document
+from frappe.utils import add_days, flt, get_last_day, getdate, now, today
+
+from custom_stock_ageing_report.custom_stock_ageing_report.report.custom_stock_ageing.custom_stock_ageing import (
+	FIFOSlots,
+	get_ageing_boundaries,
+	get_ageing_data,
+	get_ageing_ranges_key,
+	get_float_precision,
+	get_valuation_rates,
+	is_ledger_changed_since,
+)
+
+SNAPSHOT_FIELDS = (
+	"name",
+	"creation",
+	"modified",
+	"owner",
+	"modified_by",
+	"company",
+	"snapshot_date",
+	"item_code",
+	"warehouse",
+	"ageing_ranges",
+	"qty",
+	"valuation_rate",
+	"stock_value",
+	"average_age",
+	"earliest_age",
+	"latest_age",
+	"range_qty",
+	"range_value",
+)
+
+# daily snapshots are kept for a month, month end snapshots are kept
+RETENTION_DAYS = 31
+
+
+class StockAgeingSnapshot(Document):
+	pass
+
+
+def on_doctype_update():
+	frappe.db.add_index("Stock Ageing Snapshot", ["company", "snapshot_date", "ageing_ranges"])
+
+
+def create_stock_ageing_snapshots():
+	"Daily job, snapshot stock ageing of each company as of yesterday."
+	snapshot_date = getdate(add_days(today(), -1))
+
+	for company in frappe.get_all("Company", pluck="name"):
+		create_stock_ageing_snapshot(company, snapshot_date)
+		delete_expired_snapshots(company, snapshot_date)
+		frappe.db.commit()
+
+
+def create_stock_ageing_snapshot(company: str, snapshot_date):
+	"""
+	Store (item, warehouse) wise ageing as on `snapshot_date` for the ageing ranges set in
+	`stock_ageing_snapshot_ranges` of site config (default 30, 60, 90).
+	"""
+	filters = frappe._dict(
+		company=company,
+		to_date=snapshot_date,
+		show_warehouse_wise_stock=True,
+		ageing_ranges=frappe.conf.get("stock_ageing_snapshot_ranges") or "30, 60, 90",
+	)
+	boundaries = get_ageing_boundaries(filters)
+	ageing_ranges = get_ageing_ranges_key(boundaries)
+
+	started = now()
+	item_details = FIFOSlots(filters).generate()
+	if is_ledger_changed_since(company, snapshot_date, started):
+		# back-dated entry posted while replaying, its invalidation may already have run
+		return
+
+	item_codes = list({key[0] for key in item_details})
+	valuation_rates = get_valuation_rates(item_details, item_codes)
+	precision = get_float_precision()
+
+	timestamp, user = now(), frappe.session.user
+	date_ordinals, rows = {}, []
+	for (item_code, warehouse), item_dict in item_details.items():
+		qty = flt(item_dict.get("total_qty"), precision)
+		if not qty:
+			continue
+
+		ageing_data = get_ageing_data(
+			item_dict["fifo_queue"], snapshot_date, boundaries, precision, date_ordinals
+		)
+		if not ageing_data:
+			continue
+
+		valuation_rate = valuation_rates.get((item_code, warehouse)) or 0.0
+		rows.append(
+			(
+				frappe.generate_hash(length=10),
+				timestamp,
+				timestamp,
+				user,
+				user,
+				company,
+				snapshot_date,
+				item_code,
+				warehouse,
+				ageing_ranges,
+				qty,
+				valuation_rate,
+				qty * valuation_rate,
+				ageing_data.average_age,
+				ageing_data.earliest_age,
+				ageing_data.latest_age,
+				json.dumps(ageing_data.range_qty),
+				json.dumps([range_qty * valuation_rate for range_qty in ageing_data.range_qty]),
+			)
+		)
+
+	frappe.db.delete(
+		"Stock Ageing Snapshot",
+		{"company": company, "snapshot_date": snapshot_date, "ageing_ranges": ageing_ranges},
+	)
+	frappe.db.bulk_insert("Stock Ageing Snapshot", SNAPSHOT_FIELDS, rows, chunk_size=5000)
+
+
+def delete_expired_snapshots(company: str, snapshot_date):
+	"Delete daily snapshots older than the retention period, except month end ones."
+	expired_dates = frappe.get_all(
+		"Stock Ageing Snapshot",
+		filters={"company": company, "snapshot_date": ("<", add_days(snapshot_date, -RETENTION_DAYS))},
+		pluck="snapshot_date",
+		distinct=True,
+	)
+
+	expired_dates = [d for d in expired_dates if getdate(d) != get_last_day(d)]
+	if expired_dates:
+		frappe.db.delete(
+			"Stock Ageing Snapshot", {"company": company, "snapshot_date": ("in", expired_dates)}
+		)
+
+
+def delete_stock_ageing_snapshots(company: str, from_date):
+	"Snapshots on or after a back-dated change are stale, the report runs live for those dates."
+	frappe.db.delete("Stock Ageing Snapshot", {"company": company, "snapshot_date": (">=", from_date)})
@@ -0,0 +1,26 @@
+# Copyright (c) 2024, sushant and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+
+# columns a page of the report can be sorted on, each indexed with the prepared report
+SORT_FIELDS = (
+	"row_no",
+	"item_code",
+	"item_group",
+	"warehouse",
+	"bal_qty",
+	"bal_val",
+	"price_list_rate",
+	"average_age",
+)
+
+
+class StockBalanceReportRow(Document):
+	pass
+
+
+def on_doctype_update():
+	for fieldname in SORT_FIELDS:
+		frappe.db.add_index("Stock Balance Report Row", ["prepared_report", fieldname])
@@ -2,6 +2,11 @@
 // For license information, please see license.txt
 /* eslint-disable */
 
+function set_tree_view(report) {
+    // Item Group / Brand subtotal rows with their item rows, flat list otherwise
+    report.tree_report = report.report_settings.tree = Boolean(report.get_filter_value("group_by"));
+}
+
 frappe.query_reports["Custom stock ageing"] = {
     "filters": [
         {
@@ -67,11 +72,75 @@ frappe.query_reports["Custom stock ageing"] = {
             "default": "90",
             "reqd": 1
         },
+        {
+            "fieldname": "ageing_ranges",
+            "label": __("Ageing Ranges (Days)"),
+            "fieldtype": "Data",
+            "description": __("Comma separated, eg: 15, 30, 60, 90, 180, 365. Overrides Ageing Range 1 to 3.")
+        },
         {
             "fieldname": "show_warehouse_wise_stock",
             "label": __("Show Warehouse-wise Stock"),
             "fieldtype": "Check",
             "default": 1
+        },
+        {
+            "fieldname": "group_by",
+            "label": __("Group By"),
+            "fieldtype": "Select",
+            "options": "\nItem Group\nBrand",
+            on_change: () => {
+                set_tree_view(frappe.query_report);
+                frappe.query_report.refresh();
+            }
+        },
+        {
+            "fieldname": "chart_metric",
+            "label": __("Chart Metric"),
+            "fieldtype": "Select",
+            "options": "Average Age\nValue Above Last Range\nBalance Value",
+            "default": "Average Age"
+        },
+        {
+            "fieldname": "chart_top_n",
+            "label": __("Chart Top N Items"),
+            "fieldtype": "Int",
+            "default": 10
+        },
+        {
+            "fieldname": "ageing_engine",
+            "label": __("Ageing Engine"),
+            "fieldtype": "Select",
+            "options": "FIFO Replay\nReverse FIFO\nParallel FIFO Replay",
+            "default": "FIFO Replay",
+            "description": __("Reverse FIFO leaves out warehouses with negative stock, item level ranges then differ from FIFO Replay")
+        },
+        {
+            "fieldname": "replay_batch_items",
+            "label": __("Replay Batch Items"),
+            "fieldtype": "Check",
+            "default": 0,
+            "description": __("Batch items are aged from the first receipt of each batch in the warehouse, same as the replay when the oldest batch is consumed first. Check to age them by FIFO replay.")
+        },
+        {
+            "fieldname": "from_snapshot",
+            "label": __("From Daily Snapshot"),
+            "fieldtype": "Check",
+            "default": 0,
+            "description": __("Read the Stock Ageing Snapshot of the As On Date, runs live if there is none")
+        },
+        {
+            "fieldname": "show_ageing_trend",
+            "label": __("Show Ageing Trend"),
+            "fieldtype": "Check",
+            "default": 0
+        },
+        {
+            "fieldname": "trend_periods",
+            "label": __("Trend Periods (Month Ends)"),
+            "fieldtype": "Int",
+            "default": 12,
+            "depends_on": "eval: doc.show_ageing_trend"
         },
 		{
             "fieldname": "price_list",
@@ -84,5 +153,21 @@ frappe.query_reports["Custom stock ageing"] = {
                 return { filters: { "selling": 1, "custom_use_for_calculation": 1 } };
             }
         }
-    ]
+    ],
+    "formatter": function (value, row, column, data, default_formatter) {
+        if (data && data.is_group && column.fieldname == "item_code") {
+            // Item Group / Brand subtotal row
+            return `<b>${frappe.utils.escape_html(value)}</b>`;
+        }
+
+        value = default_formatter(value, row, column, data);
+        return data && data.is_group ? `<b>${value}</b>` : value;
+    },
+    "onload": function (report) {
+        set_tree_view(report);
+    },
+    "tree": false,
+    "name_field": "item_code",
+    "parent_field": "parent_group",
+    "initial_depth": 3
 }
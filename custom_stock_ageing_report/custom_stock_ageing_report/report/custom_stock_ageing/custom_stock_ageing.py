@@ -2,74 +2,249 @@
 # License: GNU General Public License v3. See license.txt
 
 
-from operator import itemgetter
-from typing import Dict, List, Tuple, Union
+import json
+import multiprocessing
+import os
+from array import array
+from bisect import bisect_left
+from collections import defaultdict, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+from itertools import chain
+from heapq import nlargest
+from operator import itemgetter, mul
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
 import frappe
 from frappe import _
-from frappe.utils import cint, date_diff, flt
+from frappe.query_builder import Order
+from frappe.query_builder.functions import IfNull
+from frappe.utils import add_months, cint, date_diff, flt, get_last_day, getdate
 
 from erpnext.stock.doctype.serial_no.serial_no import get_serial_nos
 
 Filters = frappe._dict
 
+# stock ledger entry as streamed to `FIFOSlots`, ledger columns only,
+# item attributes are joined when formatting, see `get_item_map`
+SLERow = namedtuple(
+	"SLERow",
+	[
+		"name",
+		"has_serial_no",
+		"actual_qty",
+		"posting_date",
+		"voucher_type",
+		"voucher_no",
+		"serial_no",
+		"batch_no",
+		"qty_after_transaction",
+		"warehouse",
+	],
+)
+
+# items aged per batch from batch balances instead of the FIFO replay, see `FIFOSlots`
+BATCH_ITEM_CONDITION = "item.has_batch_no = 1 and item.has_serial_no = 0"
+
+# worker processes of a `ParallelFIFOSlots` replay, unless set in site config
+DEFAULT_STOCK_AGEING_WORKERS = 2
+PARALLEL_REPLAY_MIN_ITEMS = 5000
+# seconds after which the parallel replay lock of a crashed run is released
+PARALLEL_REPLAY_LOCK_TIMEOUT = 3600
+
 
 def execute(filters: Filters = None) -> Tuple:
+	if filters.get("show_ageing_trend"):
+		return get_ageing_trend(filters)
+
 	to_date = filters["to_date"]
 	columns = get_columns(filters)
 
-	item_details = FIFOSlots(filters).generate()
-	data = format_report_data(filters, item_details, to_date)
+	item_details = None
+	data = get_snapshot_data(filters) if filters.get("from_snapshot") else None
+	if data is None:
+		# live run, also when there is no snapshot as on the to date
+		item_details = get_fifo_slots_engine(filters).generate()
+		data = format_report_data(filters, item_details, to_date)
 
-	chart_data = get_chart_data(data, filters)
+	if filters.get("group_by") or filters.get("show_warehouse_wise_stock"):
+		# rollup and warehouse rows are charted item wise, from the same replay
+		chart_data = get_item_wise_chart_data(filters, item_details)
+	else:
+		chart_data = get_chart_data(data, filters)
 
 	return columns, data, None, chart_data
 
+
+def get_snapshot_data(filters: Filters) -> Optional[List]:
+	"""
+	Returns report rows from the Stock Ageing Snapshot as on the to date, or None if there is
+	no snapshot on that date for the ageing ranges in the filters or the ledger changed since.
+	"""
+	ageing_ranges = get_ageing_ranges_key(get_ageing_boundaries(filters))
+	snapshot_filters = {
+		"company": filters.get("company"),
+		"snapshot_date": filters.get("to_date"),
+		"ageing_ranges": ageing_ranges,
+	}
+	created = frappe.db.get_value(
+		"Stock Ageing Snapshot", snapshot_filters, "creation", order_by="creation asc"
+	)
+	if not created:
+		return None
+
+	# a back-dated change deletes later snapshots in a job queued after it commits,
+	# until that job runs the report runs live
+	if is_ledger_changed_since(filters.get("company"), filters.get("to_date"), created):
+		return None
+
+	conditions, values = get_item_warehouse_conditions(filters, "snapshot")
+	conditions = [
+		"snapshot.company = %(company)s",
+		"snapshot.snapshot_date = %(snapshot_date)s",
+		"snapshot.ageing_ranges = %(ageing_ranges)s",
+	] + conditions
+	values.update(snapshot_filters)
+
+	snapshot_rows = frappe.db.sql(
+		f"""
+		select
+			snapshot.item_code, snapshot.warehouse, snapshot.qty, snapshot.stock_value,
+			snapshot.valuation_rate, snapshot.average_age, snapshot.earliest_age,
+			snapshot.latest_age, snapshot.range_qty, snapshot.range_value
+		from `tabStock Ageing Snapshot` snapshot
+		inner join `tabItem` item on item.name = snapshot.item_code
+		where {" and ".join(conditions)}
+		order by snapshot.item_code, snapshot.warehouse
+		""",
+		values,
+		as_dict=True,
+	)
+
+	# (item, warehouse) or item wise totals
+	warehouse_wise = filters.get("show_warehouse_wise_stock")
+	totals = {}
+	for d in snapshot_rows:
+		key = (d.item_code, d.warehouse) if warehouse_wise else d.item_code
+		range_qty, range_value = json.loads(d.range_qty), json.loads(d.range_value)
+
+		if key not in totals:
+			totals[key] = frappe._dict(
+				d,
+				qty=0.0,
+				stock_value=0.0,
+				age_qty=0.0,
+				range_qty=[0.0] * len(range_qty),
+				range_value=[0.0] * len(range_value),
+			)
+
+		row = totals[key]
+		row.qty += flt(d.qty)
+		row.stock_value += flt(d.stock_value)
+		row.age_qty += flt(d.average_age) * flt(d.qty)
+		row.earliest_age = max(row.earliest_age, d.earliest_age)
+		row.latest_age = min(row.latest_age, d.latest_age)
+		row.range_qty = list(map(sum, zip(row.range_qty, range_qty)))
+		row.range_value = list(map(sum, zip(row.range_value, range_value)))
+
+	item_codes = list({row.item_code for row in totals.values()})
+	item_map = get_item_map(item_codes)
+	price_list_rates = get_price_list_rates(filters.get("price_list"), item_codes, filters.get("to_date"))
+	precision = get_float_precision()
+	rollup = AgeingRollup(filters) if filters.get("group_by") else None
+
+	data = []
+	for row in totals.values():
+		item_data = item_map.get(row.item_code) or frappe._dict()
+		valuation_rate = row.stock_value / row.qty if row.qty else flt(row.valuation_rate)
+
+		report_row = [
+			row.item_code,
+			item_data.item_name,
+			item_data.description,
+			item_data.item_group,
+			item_data.brand,
+		]
+
+		if warehouse_wise:
+			report_row.append(row.warehouse)
+
+		report_row.extend(
+			[
+				flt(row.qty, precision),
+				price_list_rates.get(row.item_code) or 0.0,
+				valuation_rate,
+				row.stock_value,
+				flt(row.age_qty / row.qty, 2) if row.qty else 0.0,
+			]
+		)
+
+		for range_qty, range_value in zip(row.range_qty, row.range_value):
+			report_row.extend([flt(range_qty, precision), range_value])
+
+		report_row.extend([row.earliest_age, row.latest_age, item_data.stock_uom])
+
+		if rollup:
+			rollup.add(item_data, report_row)
+		else:
+			data.append(report_row)
+
+	return rollup.get_data() if rollup else data
+
+
+def get_fifo_slots_engine(filters: Filters, sle: List = None):
+	"Returns the FIFO slots engine selected in the report filters."
+	if filters.get("ageing_engine") == "Reverse FIFO":
+		return ReverseFIFOSlots(filters, sle)
+
+	if filters.get("ageing_engine") == "Parallel FIFO Replay":
+		return ParallelFIFOSlots(filters, sle)
+
+	return FIFOSlots(filters, sle)
+
+
 @frappe.whitelist()
 def format_report_data(filters: Filters, item_details: Dict, to_date: str) -> List[Dict]:
 	"Returns ordered, formatted data with ranges."
-	_func = itemgetter(1)
 	data = []
 
-	precision = cint(frappe.db.get_single_value("System Settings", "float_precision", cache=True))
+	context = get_report_context(filters, item_details)
+	precision = context.precision
+	boundaries = get_ageing_boundaries(filters)
+	date_ordinals = {}
+
+	rollup = AgeingRollup(filters) if filters.get("group_by") else None
 
 	for item, item_dict in item_details.items():
 		if not flt(item_dict.get("total_qty"), precision):
 			continue
 
-		earliest_age, latest_age = 0, 0
 		details = item_dict["details"]
 
-		fifo_queue = sorted(filter(_func, item_dict["fifo_queue"]), key=_func)
+		ageing_data = get_ageing_data(
+			item_dict["fifo_queue"], to_date, boundaries, precision, date_ordinals
+		)
 
-		if not fifo_queue:
+		if not ageing_data:
 			continue
 
-		average_age = get_average_age(fifo_queue, to_date)
-		earliest_age = date_diff(to_date, fifo_queue[0][1])
-		latest_age = date_diff(to_date, fifo_queue[-1][1])
-		range1, range2, range3, above_range3 = get_range_age(filters, fifo_queue, to_date, item_dict)
-
-		price_list_rate = frappe.db.get_value("Item Price", {
-            "price_list": filters.get("price_list"),
-            "item_code": details.name
-        }, "price_list_rate")
-
-		valuation_rate = frappe.db.get_value("Bin", {
-            "item_code": details.name,
-            "warehouse": details.warehouse
-        }, "valuation_rate")
-
-		
+		average_age = ageing_data.average_age
+		earliest_age = ageing_data.earliest_age
+		latest_age = ageing_data.latest_age
 
-		bal_val = flt(item_dict.get("total_qty"), precision) * (valuation_rate if valuation_rate else 0.0)
+		item_data = context.item_map.get(details.name) or frappe._dict()
+		price_list_rate = context.price_list_rates.get(details.name) or 0.0
+		valuation_rate = context.valuation_rates.get(item) or 0.0
 
-		bal_val_range1 = range1 * (valuation_rate if valuation_rate else 0.0)
-		bal_val_range2 = range2 * (valuation_rate if valuation_rate else 0.0)
-		bal_val_range3 = range3 * (valuation_rate if valuation_rate else 0.0)
-		bal_val_above_range3 = above_range3 * (valuation_rate if valuation_rate else 0.0)
+		bal_val = flt(item_dict.get("total_qty"), precision) * valuation_rate
 
-		row = [details.name, details.item_name, details.description, details.item_group, details.brand]
+		row = [
+			details.name,
+			item_data.item_name,
+			item_data.description,
+			item_data.item_group,
+			item_data.brand,
+		]
 
 		if filters.get("show_warehouse_wise_stock"):
 			row.append(details.warehouse)
@@ -77,28 +252,295 @@ def format_report_data(filters: Filters, item_details: Dict, to_date: str) -> Li
 		row.extend(
 			[
 				flt(item_dict.get("total_qty"), precision),
-				price_list_rate if price_list_rate else 0.0,
-				valuation_rate if valuation_rate else 0.0,
-				# bal_val_range1 + bal_val_range2 + bal_val_range3 + bal_val_above_range3,  # Total Balance Value	
+				price_list_rate,
+				valuation_rate,
+				# bal_val_range1 + bal_val_range2 + bal_val_range3 + bal_val_above_range3,  # Total Balance Value
 				bal_val,
 				average_age,
-				range1,
-				bal_val_range1,
-				range2,
-				bal_val_range2,
-				range3,
-				bal_val_range3,
-				above_range3,
-                bal_val_above_range3,
-				earliest_age,
-				latest_age,
-				details.stock_uom,
 			]
 		)
 
-		data.append(row)
+		# qty and balance value per ageing range
+		for range_qty in ageing_data.range_qty:
+			row.extend([range_qty, range_qty * valuation_rate])
+
+		row.extend([earliest_age, latest_age, item_data.stock_uom])
+
+		if rollup:
+			rollup.add(item_data, row)
+		else:
+			data.append(row)
+
+	return rollup.get_data() if rollup else data
+
+
+class AgeingRollup:
+	"""
+	Subtotals of report rows per Item Group (into each of its parent groups too) or per Brand,
+	added into as the item rows are built. Rows are returned as an indented tree.
+
+	Parent groups of each Item Group are worked out once from the `lft`/`rgt` nested set.
+	"""
+
+	def __init__(self, filters: Filters):
+		self.group_by = filters.get("group_by")
+		self.fieldnames = [column["fieldname"] for column in get_columns(filters)]
+		self.sum_fields = [
+			fieldname
+			for fieldname in self.fieldnames
+			if fieldname in ("qty", "bal_val") or fieldname.startswith(("range", "bal_val_"))
+		]
+
+		# group: totals, group: item rows
+		self.totals = {}
+		self.item_rows = defaultdict(list)
 
-	return data
+		# group: (depth, [group and its parent groups]), in tree order
+		self.groups = get_item_group_ancestors() if self.group_by == "Item Group" else {}
+
+	def add(self, item_data: frappe._dict, row: List):
+		"Add an item row into its group and the group's parent groups."
+		row = frappe._dict(zip(self.fieldnames, row))
+
+		if self.group_by == "Item Group":
+			group = item_data.item_group or _("No Item Group")
+		else:
+			group = item_data.brand or _("No Brand")
+
+		self.item_rows[group].append(row)
+		ancestors = self.groups[group][1] if group in self.groups else [group]
+
+		for name in ancestors:
+			totals = self.totals.get(name)
+			if totals is None:
+				totals = self.totals[name] = frappe._dict(
+					{fieldname: 0.0 for fieldname in self.sum_fields},
+					age_qty=0.0,
+					earliest=row.earliest,
+					latest=row.latest,
+				)
+
+			for fieldname in self.sum_fields:
+				totals[fieldname] += flt(row[fieldname])
+
+			totals.age_qty += flt(row.average_age) * flt(row.qty)
+			totals.earliest = max(totals.earliest, row.earliest)
+			totals.latest = min(totals.latest, row.latest)
+
+	def get_data(self) -> List[Dict]:
+		"Group rows followed by their item rows, groups in tree order (Brands by name)."
+		if self.group_by == "Item Group":
+			groups = [
+				(name, depth, ancestors[-2] if depth else None)
+				for name, (depth, ancestors) in self.groups.items()
+			]
+			# groups of deleted Item Groups go last
+			groups.extend((name, 0, None) for name in sorted(self.totals) if name not in self.groups)
+		else:
+			groups = [(name, 0, None) for name in sorted(self.totals)]
+
+		data = []
+		for name, depth, parent_group in groups:
+			totals = self.totals.get(name)
+			if not totals:
+				continue
+
+			qty = totals.pop("qty")
+			age_qty = totals.pop("age_qty")
+			group_row = frappe._dict(
+				totals, item_code=name, qty=qty, parent_group=parent_group, indent=depth, is_group=1
+			)
+			group_row.average_age = flt(age_qty / qty, 2) if qty else 0.0
+			group_row.val_rate = totals.bal_val / qty if qty else 0.0
+			data.append(group_row)
+
+			for row in self.item_rows.get(name, []):
+				row.update({"parent_group": name, "indent": depth + 1})
+				data.append(row)
+
+		return data
+
+
+def get_item_group_ancestors() -> Dict[str, Tuple[int, List[str]]]:
+	"Returns depth and list of the group and all its parent groups per Item Group, in tree order."
+	item_groups = frappe.get_all(
+		"Item Group", fields=["name", "lft", "rgt"], order_by="lft", as_list=True
+	)
+
+	ancestors, stack = {}, []
+	for name, lft, rgt in item_groups:
+		while stack and stack[-1][2] < lft:
+			stack.pop()
+
+		stack.append((name, lft, rgt))
+		ancestors[name] = (len(stack) - 1, [d[0] for d in stack])
+
+	return ancestors
+
+
+def get_report_context(filters: Filters, item_details: Dict) -> frappe._dict:
+	"""
+	Load everything `format_report_data` needs per row in a few set based queries:
+	float precision, item attributes and price list rate per item and valuation rate per report key.
+	"""
+	item_codes = list({key[0] if isinstance(key, tuple) else key for key in item_details})
+
+	return frappe._dict(
+		{
+			"precision": get_float_precision(),
+			"item_map": get_item_map(item_codes),
+			"price_list_rates": get_price_list_rates(
+				filters.get("price_list"), item_codes, filters.get("to_date")
+			),
+			"valuation_rates": get_valuation_rates(item_details, item_codes),
+		}
+	)
+
+
+def get_float_precision() -> int:
+	return cint(frappe.db.get_single_value("System Settings", "float_precision", cache=True)) or 3
+
+
+def get_item_map(item_codes: List[str]) -> Dict[str, frappe._dict]:
+	"Returns item attributes shown in the report, loaded once per item."
+	if not item_codes:
+		return {}
+
+	item = frappe.qb.DocType("Item")
+	result = (
+		frappe.qb.from_(item)
+		.select(item.name, item.item_name, item.description, item.item_group, item.brand, item.stock_uom)
+		.where(item.name.isin(item_codes))
+	).run(as_dict=True)
+
+	return {d.name: d for d in result}
+
+
+def get_price_list_rates(price_list: str, item_codes: List[str], to_date=None) -> Dict[str, float]:
+	"""
+	Returns the price list rate per item valid on `to_date`. When an item has several valid
+	prices the one valid from the latest date wins, prices without a valid from date come last.
+	"""
+	if not (price_list and item_codes):
+		return {}
+
+	to_date = getdate(to_date)
+	item_price = frappe.qb.DocType("Item Price")
+	result = (
+		frappe.qb.from_(item_price)
+		.select(item_price.item_code, item_price.price_list_rate)
+		.where(
+			(item_price.price_list == price_list)
+			& (item_price.item_code.isin(item_codes))
+			& (item_price.valid_from.isnull() | (item_price.valid_from <= to_date))
+			& (item_price.valid_upto.isnull() | (item_price.valid_upto >= to_date))
+		)
+		.orderby(IfNull(item_price.valid_from, "0001-01-01"), order=Order.desc)
+	).run()
+
+	price_list_rates = {}
+	for item_code, rate in result:
+		price_list_rates.setdefault(item_code, flt(rate))
+
+	return price_list_rates
+
+
+def get_valuation_rates(item_details: Dict, item_codes: List[str]) -> Dict:
+	"""
+	Returns valuation rate per report key.
+	Key = (Item, Warehouse): valuation rate of the Bin
+	Key = Item: balance value / balance qty across the Bins of the warehouses the item was aged in
+	"""
+	if not item_codes:
+		return {}
+
+	bin_table = frappe.qb.DocType("Bin")
+	bins = (
+		frappe.qb.from_(bin_table)
+		.select(
+			bin_table.item_code,
+			bin_table.warehouse,
+			bin_table.actual_qty,
+			bin_table.stock_value,
+			bin_table.valuation_rate,
+		)
+		.where(bin_table.item_code.isin(item_codes))
+	).run(as_dict=True)
+	bins = {(d.item_code, d.warehouse): d for d in bins}
+
+	valuation_rates = {}
+	for key, item_dict in item_details.items():
+		if isinstance(key, tuple):
+			if bin_row := bins.get(key):
+				valuation_rates[key] = flt(bin_row.valuation_rate)
+			continue
+
+		stock_qty = stock_value = 0.0
+		warehouses = item_dict.get("warehouses") or []
+		for warehouse in warehouses:
+			if bin_row := bins.get((key, warehouse)):
+				stock_qty += flt(bin_row.actual_qty)
+				stock_value += flt(bin_row.stock_value)
+
+		if stock_qty:
+			valuation_rates[key] = stock_value / stock_qty
+		elif warehouses and (bin_row := bins.get((key, warehouses[-1]))):
+			valuation_rates[key] = flt(bin_row.valuation_rate)
+
+	return valuation_rates
+
+
+def get_ageing_data(
+	fifo_queue: Iterable,
+	to_date: str,
+	boundaries: List[float],
+	precision: int,
+	date_ordinals: Dict = None,
+) -> Optional[frappe._dict]:
+	"""
+	Returns average, earliest and latest age and qty per ageing range of the slots.
+
+	Slot dates are kept as day ordinals (parsed once per date, `date_ordinals` can be
+	shared across items), slots are put in a range by binary search over the range
+	boundaries and range qty is rounded once instead of after every addition.
+	"""
+	if date_ordinals is None:
+		date_ordinals = {}
+
+	to_date_ordinal = getdate(to_date).toordinal()
+	ages, qtys = array("l"), array("d")
+
+	for slot in fifo_queue:
+		posting_date = slot[1]
+		if not posting_date:
+			continue
+
+		ordinal = date_ordinals.get(posting_date)
+		if ordinal is None:
+			ordinal = date_ordinals[posting_date] = getdate(posting_date).toordinal()
+
+		ages.append(to_date_ordinal - ordinal)
+		# Serial No slots hold the serial no as qty
+		qtys.append(1.0 if isinstance(slot[0], str) else flt(slot[0]))
+
+	if not ages:
+		return None
+
+	range_qty = [0.0] * (len(boundaries) + 1)
+	for age, qty in zip(ages, qtys):
+		range_qty[bisect_left(boundaries, age)] += qty
+
+	total_qty = sum(qtys)
+	age_qty = sum(map(mul, ages, qtys))
+
+	return frappe._dict(
+		{
+			"average_age": flt(age_qty / total_qty, 2) if total_qty else 0.0,
+			"earliest_age": max(ages),
+			"latest_age": min(ages),
+			"range_qty": [flt(qty, precision) for qty in range_qty],
+		}
+	)
 
 
 def get_average_age(fifo_queue: List, to_date: str) -> float:
@@ -116,26 +558,25 @@ def get_average_age(fifo_queue: List, to_date: str) -> float:
 	return flt(age_qty / total_qty, 2) if total_qty else 0.0
 
 
-def get_range_age(filters: Filters, fifo_queue: List, to_date: str, item_dict: Dict) -> Tuple:
-
-	precision = cint(frappe.db.get_single_value("System Settings", "float_precision", cache=True))
+def get_ageing_ranges_key(boundaries: List[float]) -> str:
+	"Ageing range bounds as stored on the Stock Ageing Snapshot, eg: 30,60,90."
+	return ",".join(f"{boundary:g}" for boundary in boundaries)
 
-	range1 = range2 = range3 = above_range3 = 0.0
 
-	for item in fifo_queue:
-		age = flt(date_diff(to_date, item[1]))
-		qty = flt(item[0]) if not item_dict["has_serial_no"] else 1.0
+def get_ageing_boundaries(filters: Filters) -> List[float]:
+	"""
+	Returns upper bounds (in days) of the ageing ranges, from the comma separated
+	`ageing_ranges` filter if set else from Ageing Range 1 to 3. Ages above the last
+	bound fall in one more range.
+	"""
+	ageing_ranges = filters.get("ageing_ranges")
+	if isinstance(ageing_ranges, str):
+		ageing_ranges = [d for d in ageing_ranges.replace(";", ",").split(",") if d.strip()]
 
-		if age <= flt(filters.range1):
-			range1 = flt(range1 + qty, precision)
-		elif age <= flt(filters.range2):
-			range2 = flt(range2 + qty, precision)
-		elif age <= flt(filters.range3):
-			range3 = flt(range3 + qty, precision)
-		else:
-			above_range3 = flt(above_range3 + qty, precision)
+	if not ageing_ranges:
+		ageing_ranges = [filters.get("range1"), filters.get("range2"), filters.get("range3")]
 
-	return range1, range2, range3, above_range3
+	return sorted({flt(d) for d in ageing_ranges if flt(d) > 0})
 
 
 def get_columns(filters: Filters) -> List[Dict]:
@@ -189,14 +630,20 @@ def get_columns(filters: Filters) -> List[Dict]:
 	)
 
 	age_balance_columns = []
-	for age_col, bal_col in zip(range_columns, [
-        {"label": _("Balance Valuation 1"), "fieldname": "bal_val_range1", "fieldtype": "Currency", "width": 120},
-        {"label": _("Balance Valuation 2"), "fieldname": "bal_val_range2", "fieldtype": "Currency", "width": 120},
-        {"label": _("Balance Valuation 3"), "fieldname": "bal_val_range3", "fieldtype": "Currency", "width": 120},
-        {"label": _("Balance Valuation 4"), "fieldname": "bal_val_above_range3", "fieldtype": "Currency", "width": 120},
-    ]):
-		age_balance_columns.extend([age_col, bal_col])
-    
+	for i, age_col in enumerate(range_columns):
+		# last range is above the last bound, eg: bal_val_above_range3
+		bal_fieldname = (
+			f"bal_val_range{i + 1}" if i < len(range_columns) - 1 else f"bal_val_above_range{i}"
+		)
+		age_balance_columns.append(age_col)
+		add_column(
+			age_balance_columns,
+			label=_("Balance Valuation {0}").format(i + 1),
+			fieldname=bal_fieldname,
+			fieldtype="Currency",
+			width=120,
+		)
+
 	columns.extend(age_balance_columns)
 
 	# columns.extend(range_columns)
@@ -216,36 +663,242 @@ def get_columns(filters: Filters) -> List[Dict]:
 
 
 def get_chart_data(data: List, filters: Filters) -> Dict:
+	"""
+	Bar chart of the top N items (Chart Top N, default 10) by the Chart Metric.
+	Rows are picked with a bounded heap, report rows and their order are left as is.
+	"""
 	if not data:
 		return []
 
-	labels, datapoints = [], []
-
 	if filters.get("show_warehouse_wise_stock"):
 		return {}
 
-	data.sort(key=lambda row: row[6], reverse=True)
+	metric = filters.get("chart_metric") or "Average Age"
+	fieldnames = [column["fieldname"] for column in get_columns(filters)]
+	metric_fieldname = {
+		"Average Age": "average_age",
+		"Balance Value": "bal_val",
+		"Value Above Last Range": fieldnames[fieldnames.index("earliest") - 1],
+	}[metric]
+	metric_index = fieldnames.index(metric_fieldname)
+
+	top_rows = nlargest(cint(filters.get("chart_top_n")) or 10, data, key=itemgetter(metric_index))
+
+	return {
+		"data": {
+			"labels": [row[0] for row in top_rows],
+			"datasets": [{"name": _(metric), "values": [row[metric_index] for row in top_rows]}],
+		},
+		"type": "bar",
+	}
+
+
+@frappe.whitelist()
+def get_ageing_chart(filters: Union[str, Dict]) -> Dict:
+	"Returns only the chart of the report, item wise, see `get_item_wise_chart_data`."
+	if not frappe.get_cached_doc("Report", "Custom stock ageing").is_permitted():
+		frappe.throw(_("Not permitted"), frappe.PermissionError)
+
+	return get_item_wise_chart_data(frappe._dict(frappe.parse_json(filters)))
+
+
+def get_item_wise_chart_data(filters: Filters, item_details: Dict = None) -> Dict:
+	"""
+	Returns the chart of the top items whatever the report rows are grouped by.
+
+	Built from `item_details` of the report replay if given (warehouse wise ones are added up
+	per item), else from the Stock Ageing Snapshot as on the to date or a live replay.
+	"""
+	filters = frappe._dict(filters, show_warehouse_wise_stock=0, group_by=None)
+
+	if item_details is None:
+		data = get_snapshot_data(filters) if filters.get("from_snapshot") else None
+		if data is not None:
+			return get_chart_data(data, filters)
+
+		item_details = get_fifo_slots_engine(filters).generate()
+	elif any(isinstance(key, tuple) for key in item_details):
+		item_details = aggregate_details_by_item(item_details)
+
+	return get_chart_data(format_report_data(filters, item_details, filters["to_date"]), filters)
+
+
+def get_ageing_trend(filters: Filters, as_on_dates: List = None) -> Tuple:
+	"""
+	Returns ageing as on each date (month ends up to `to_date` by default) and a trend chart.
+	The ledger is replayed once up to the latest date, ageing is snapshotted as the replay
+	crosses each date.
+	"""
+	if not as_on_dates:
+		as_on_dates = get_trend_dates(filters["to_date"], cint(filters.get("trend_periods")) or 12)
+
+	as_on_dates = sorted(getdate(as_on_date) for as_on_date in as_on_dates)
+
+	filters = frappe._dict(filters)
+	filters.to_date = as_on_dates[-1]
+
+	fifo_slots = FIFOSlots(filters, snapshot_dates=as_on_dates)
+	fifo_slots.generate()
+
+	item_map = get_item_map(
+		list({snapshot.details.name for d in fifo_slots.snapshots.values() for snapshot in d.values()})
+	)
+
+	data = []
+	for as_on_date in as_on_dates:
+		for snapshot in fifo_slots.snapshots[as_on_date].values():
+			details, ageing_data = snapshot.details, snapshot.ageing_data
+			item_data = item_map.get(details.name) or frappe._dict()
+			row = [as_on_date, details.name, item_data.item_name]
+
+			if filters.get("show_warehouse_wise_stock"):
+				row.append(details.warehouse)
+
+			row.extend([snapshot.total_qty, ageing_data.average_age])
+			row.extend(ageing_data.range_qty)
+			row.extend([ageing_data.earliest_age, ageing_data.latest_age])
+			data.append(row)
+
+	return get_trend_columns(filters), data, None, get_trend_chart_data(fifo_slots.snapshots, filters)
+
+
+def get_trend_dates(to_date: str, periods: int) -> List:
+	"Returns `to_date` and the month ends before it, `periods` dates in all."
+	to_date = getdate(to_date)
+	as_on_dates = [to_date]
+
+	month_end = get_last_day(add_months(to_date, -1))
+	while len(as_on_dates) < periods:
+		as_on_dates.append(month_end)
+		month_end = get_last_day(add_months(month_end, -1))
+
+	return sorted(as_on_dates)
+
+
+def get_ageing_snapshot(
+	item_details: Dict,
+	as_on_date,
+	filters: Filters,
+	precision: int,
+	date_ordinals: Dict = None,
+	scale: int = 1,
+) -> Dict:
+	"""
+	Returns ageing of (item, warehouse) wise FIFO queues as on a date, per (item, warehouse)
+	or per item if stock is not shown warehouse-wise.
+
+	`scale` is set for queues still in fixed point qty, see `FIFOSlots`.
+	"""
+	boundaries = get_ageing_boundaries(filters)
+	warehouse_wise = filters.get("show_warehouse_wise_stock")
+
+	keys = defaultdict(list)
+	for key in item_details:
+		keys[key if warehouse_wise else key[0]].append(key)
+
+	snapshot = {}
+	for key, wh_keys in keys.items():
+		total_qty = sum(flt(item_details[wh_key].get("total_qty")) for wh_key in wh_keys)
+		total_qty = flt(total_qty / scale, precision)
+		if not total_qty:
+			continue
+
+		fifo_queue = chain.from_iterable(item_details[wh_key]["fifo_queue"] for wh_key in wh_keys)
+		ageing_data = get_ageing_data(fifo_queue, as_on_date, boundaries, precision, date_ordinals)
+		if not ageing_data:
+			continue
+
+		if scale != 1:
+			ageing_data.range_qty = [flt(qty / scale, precision) for qty in ageing_data.range_qty]
+
+		snapshot[key] = frappe._dict(
+			{
+				"details": item_details[wh_keys[-1]]["details"],
+				"total_qty": total_qty,
+				"ageing_data": ageing_data,
+			}
+		)
+
+	return snapshot
+
+
+def get_trend_columns(filters: Filters) -> List[Dict]:
+	range_columns = []
+	setup_ageing_columns(filters, range_columns)
+
+	columns = [
+		{"label": _("As On Date"), "fieldname": "as_on_date", "fieldtype": "Date", "width": 100},
+		{
+			"label": _("Item Code"),
+			"fieldname": "item_code",
+			"fieldtype": "Link",
+			"options": "Item",
+			"width": 100,
+		},
+		{"label": _("Item Name"), "fieldname": "item_name", "fieldtype": "Data", "width": 100},
+	]
+
+	if filters.get("show_warehouse_wise_stock"):
+		columns.append(
+			{
+				"label": _("Warehouse"),
+				"fieldname": "warehouse",
+				"fieldtype": "Link",
+				"options": "Warehouse",
+				"width": 100,
+			}
+		)
+
+	columns.extend(
+		[
+			{"label": _("Available Qty"), "fieldname": "qty", "fieldtype": "Float", "width": 100},
+			{"label": _("Average Age"), "fieldname": "average_age", "fieldtype": "Float", "width": 100},
+		]
+	)
+	columns.extend(range_columns)
+	columns.extend(
+		[
+			{"label": _("Earliest"), "fieldname": "earliest", "fieldtype": "Int", "width": 80},
+			{"label": _("Latest"), "fieldname": "latest", "fieldtype": "Int", "width": 80},
+		]
+	)
+
+	return columns
 
-	if len(data) > 10:
-		data = data[:10]
 
-	for row in data:
-		labels.append(row[0])
-		datapoints.append(row[6])
+def get_trend_chart_data(snapshots: Dict, filters: Filters) -> Dict:
+	"Stacked qty per ageing range as on each date."
+	range_columns = []
+	setup_ageing_columns(filters, range_columns)
+
+	labels, range_qty = [], [[] for column in range_columns]
+	for as_on_date, snapshot in snapshots.items():
+		labels.append(frappe.format(as_on_date, "Date"))
+
+		for i, qty in enumerate(range_qty):
+			qty.append(sum(row.ageing_data.range_qty[i] for row in snapshot.values()))
 
 	return {
-		"data": {"labels": labels, "datasets": [{"name": _("Average Age"), "values": datapoints}]},
+		"data": {
+			"labels": labels,
+			"datasets": [
+				{"name": column["label"], "values": values}
+				for column, values in zip(range_columns, range_qty)
+			],
+		},
 		"type": "bar",
+		"barOptions": {"stacked": 1},
 	}
 
 
 def setup_ageing_columns(filters: Filters, range_columns: List):
-	ranges = [
-		f"0 - {filters['range1']}",
-		f"{cint(filters['range1']) + 1} - {cint(filters['range2'])}",
-		f"{cint(filters['range2']) + 1} - {cint(filters['range3'])}",
-		_("{0} - Above").format(cint(filters["range3"]) + 1),
-	]
+	ranges, lower_bound = [], 0
+	for upper_bound in get_ageing_boundaries(filters):
+		ranges.append(f"{lower_bound} - {cint(upper_bound)}")
+		lower_bound = cint(upper_bound) + 1
+
+	ranges.append(_("{0} - Above").format(lower_bound))
+
 	for i, label in enumerate(ranges):
 		fieldname = "range" + str(i + 1)
 		add_column(range_columns, label=_("Age ({0})").format(label), fieldname=fieldname)
@@ -257,66 +910,259 @@ def add_column(
 	range_columns.append(dict(label=label, fieldname=fieldname, fieldtype=fieldtype, width=width))
 
 
+class FIFOSlot:
+	"Stock inwarded on a date. `qty` holds the Serial No for serialized stock."
+
+	__slots__ = ("qty", "posting_date")
+
+	def __init__(self, qty: Union[float, str], posting_date):
+		self.qty = qty
+		self.posting_date = posting_date
+
+	def __getitem__(self, index: int):
+		# readable as the [qty, posting_date] pair used by the report and Closing Stock Balance
+		return (self.qty, self.posting_date)[index]
+
+	def __iter__(self):
+		yield self.qty
+		yield self.posting_date
+
+	def __len__(self) -> int:
+		return 2
+
+	def __eq__(self, other) -> bool:
+		return list(self) == list(other)
+
+	def __repr__(self) -> str:
+		return f"[{self.qty!r}, {self.posting_date!r}]"
+
+
+class FIFOSlotQueue:
+	"""
+	FIFO Queue of `FIFOSlot`s with O(1) consumption from the head.
+	Serial Nos are indexed by serial no, so an outgoing serial no is removed in O(1).
+	Iterating yields qty slots in inward order followed by serial no slots in inward order.
+	"""
+
+	__slots__ = ("slots", "serial_nos")
+
+	def __init__(self, slots: Iterable = None):
+		self.slots = deque()
+		self.serial_nos = {}
+
+		for slot in slots or []:
+			self.add(slot)
+
+	def __iter__(self) -> Iterator[FIFOSlot]:
+		yield from self.slots
+		yield from self.serial_nos.values()
+
+	def __len__(self) -> int:
+		return len(self.slots) + len(self.serial_nos)
+
+	def __bool__(self) -> bool:
+		return bool(self.slots or self.serial_nos)
+
+	def __repr__(self) -> str:
+		return f"FIFOSlotQueue({list(self)!r})"
+
+	@property
+	def head(self) -> Optional[FIFOSlot]:
+		return self.slots[0] if self.slots else None
+
+	def append(self, slot: FIFOSlot):
+		self.slots.append(slot)
+
+	def appendleft(self, slot: FIFOSlot):
+		self.slots.appendleft(slot)
+
+	def popleft(self) -> FIFOSlot:
+		return self.slots.popleft()
+
+	def add_serial_no(self, serial_no: str, posting_date):
+		self.serial_nos[serial_no] = FIFOSlot(serial_no, posting_date)
+
+	def remove_serial_nos(self, serial_nos: List[str]):
+		for serial_no in serial_nos:
+			self.serial_nos.pop(serial_no, None)
+
+	def add(self, slot: Union[FIFOSlot, List]):
+		"Add a slot from another queue or a [qty, posting_date] pair."
+		if not isinstance(slot, FIFOSlot):
+			slot = FIFOSlot(*slot)
+
+		if isinstance(slot.qty, str):
+			self.serial_nos[slot.qty] = slot
+		else:
+			self.slots.append(slot)
+
+	def extend(self, slots: Iterable):
+		for slot in slots:
+			self.add(slot)
+
+
 class FIFOSlots:
-	"Returns FIFO computed slots of inwarded stock as per date."
+	"""
+	Returns FIFO computed slots of inwarded stock as per date.
 
-	def __init__(self, filters: Dict = None, sle: List = None):
+	Qty is replayed in fixed point, as integer units of the system float precision, so
+	slots never carry float residue and need no rounding. Slot and balance qty are
+	converted back to float once the replay is done.
+	"""
+
+	def __init__(self, filters: Dict = None, sle: Iterable = None, snapshot_dates: List = None):
 		self.item_details = {}
 		self.transferred_item_details = {}
 		self.serial_no_batch_purchase_details = {}
 		self.filters = filters
 		self.sle = sle
 
+		# dates to take ageing snapshots on while replaying, see `get_ageing_trend`
+		self.snapshot_dates = deque(sorted(getdate(d) for d in snapshot_dates or []))
+		self.snapshots = {}
+
+		# batch items are aged per batch in SQL and left out of the replay,
+		# except for snapshots and when the replay is asked for explicitly
+		self.batch_wise = (
+			sle is None and not self.snapshot_dates and not (filters or {}).get("replay_batch_items")
+		)
+
+		# transfer bucket counters, for profiling
+		self.peak_transfer_buckets = 0
+		self.evicted_transfer_buckets = 0
+
+		# system float precision and fixed point qty units per unit of stock
+		self.precision = None
+		self.scale = 1
+
 	def generate(self) -> Dict:
 		"""
 		Returns dict of the foll.g structure:
 		Key = Item A / (Item A, Warehouse A)
 		Key: {
 		        'details' -> Dict: ** item details **,
-		        'fifo_queue' -> List: ** list of lists containing entries/slots for existing stock,
+		        'fifo_queue' -> FIFOSlotQueue: ** entries/slots for existing stock,
 		                consumed/updated and maintained via FIFO. **
 		}
+
+		Ledger entries are streamed from an open unbuffered cursor, no other query can run on
+		the connection until they are consumed. Anything the replay needs from the database
+		is loaded before iterating them.
 		"""
+		# ledger qty fields have no precision of their own and are stored rounded to the
+		# system float precision, so rounding to it on the way in loses nothing by design
+		self.precision = get_float_precision()
+		self.scale = scale = 10**self.precision
+
 		if self.sle is None:
-			self.sle = self.__get_stock_ledger_entries()
+			checkpoint_date = self.__load_checkpoint()
+			self.sle = self.__get_stock_ledger_entries(checkpoint_date)
+
+		if self.batch_wise:
+			self.__load_batch_queues()
 
+		posting_date = None
 		for d in self.sle:
+			if d.posting_date != posting_date:
+				# all rows of a voucher share its posting date, earlier buckets can't be matched anymore
+				self.__evict_transfer_buckets()
+				posting_date = d.posting_date
+
+				if self.snapshot_dates:
+					self.__take_snapshots(getdate(posting_date))
+
 			key, fifo_queue, transferred_item_key = self.__init_key_stores(d)
 
+			qty_after_transaction = round(flt(d.qty_after_transaction) * scale)
 			if d.voucher_type == "Stock Reconciliation":
 				# get difference in qty shift as actual qty
 				prev_balance_qty = self.item_details[key].get("qty_after_transaction", 0)
-				d.actual_qty = flt(d.qty_after_transaction) - flt(prev_balance_qty)
+				actual_qty = qty_after_transaction - prev_balance_qty
+			else:
+				actual_qty = round(flt(d.actual_qty) * scale)
 
 			serial_nos = get_serial_nos(d.serial_no) if d.serial_no else []
 
-			if d.actual_qty > 0:
-				self.__compute_incoming_stock(d, fifo_queue, transferred_item_key, serial_nos)
+			if actual_qty > 0:
+				self.__compute_incoming_stock(d, actual_qty, fifo_queue, transferred_item_key, serial_nos)
 			else:
-				self.__compute_outgoing_stock(d, fifo_queue, transferred_item_key, serial_nos)
+				self.__compute_outgoing_stock(d, actual_qty, fifo_queue, transferred_item_key, serial_nos)
 
-			self.__update_balances(d, key)
+			self.__update_balances(d, actual_qty, qty_after_transaction, key)
+
+		if self.snapshot_dates:
+			self.__take_snapshots()
+
+		self.__convert_from_fixed_point()
 
 		if not self.filters.get("show_warehouse_wise_stock"):
 			# (Item 1, WH 1), (Item 1, WH 2) => (Item 1)
-			self.item_details = self.__aggregate_details_by_item(self.item_details)
+			self.item_details = aggregate_details_by_item(self.item_details)
 
 		return self.item_details
 
-	def __init_key_stores(self, row: Dict) -> Tuple:
+	def __take_snapshots(self, posting_date=None):
+		"Snapshot ageing as on each pending date before `posting_date` (all if not set)."
+		date_ordinals = {}
+
+		while self.snapshot_dates and (posting_date is None or self.snapshot_dates[0] < posting_date):
+			as_on_date = self.snapshot_dates.popleft()
+			self.snapshots[as_on_date] = get_ageing_snapshot(
+				self.item_details,
+				as_on_date,
+				self.filters,
+				self.precision,
+				date_ordinals,
+				scale=self.scale,
+			)
+
+	def __convert_from_fixed_point(self):
+		"Convert slot and balance qty back to float."
+		scale = self.scale
+		for item_dict in self.item_details.values():
+			for slot in item_dict["fifo_queue"].slots:
+				slot.qty /= scale
+
+			item_dict["qty_after_transaction"] = item_dict.get("qty_after_transaction", 0) / scale
+			item_dict["total_qty"] = item_dict.get("total_qty", 0) / scale
+
+	def __init_key_stores(self, row: SLERow) -> Tuple:
 		"Initialise keys and FIFO Queue."
 
 		key = (row.name, row.warehouse)
-		self.item_details.setdefault(key, {"details": row, "fifo_queue": []})
+		if key not in self.item_details:
+			self.item_details[key] = {
+				"details": frappe._dict(name=row.name, warehouse=row.warehouse),
+				"fifo_queue": FIFOSlotQueue(),
+			}
+
 		fifo_queue = self.item_details[key]["fifo_queue"]
 
 		transferred_item_key = (row.voucher_no, row.name, row.warehouse)
-		self.transferred_item_details.setdefault(transferred_item_key, [])
 
 		return key, fifo_queue, transferred_item_key
 
+	def __get_transfer_bucket(self, transfer_key: Tuple) -> deque:
+		"Returns transfer bucket of stock moved out by a voucher, created on first outward."
+		if transfer_key not in self.transferred_item_details:
+			self.transferred_item_details[transfer_key] = deque()
+			self.peak_transfer_buckets = max(
+				self.peak_transfer_buckets, len(self.transferred_item_details)
+			)
+
+		return self.transferred_item_details[transfer_key]
+
+	def __evict_transfer_buckets(self):
+		self.evicted_transfer_buckets += len(self.transferred_item_details)
+		self.transferred_item_details.clear()
+
 	def __compute_incoming_stock(
-		self, row: Dict, fifo_queue: List, transfer_key: Tuple, serial_nos: List
+		self,
+		row: SLERow,
+		actual_qty: float,
+		fifo_queue: FIFOSlotQueue,
+		transfer_key: Tuple,
+		serial_nos: List,
 	):
 		"Update FIFO Queue on inward stock."
 
@@ -325,172 +1171,681 @@ class FIFOSlots:
 			# inward/outward from same voucher, item & warehouse
 			# eg: Repack with same item, Stock reco for batch item
 			# consume transfer data and add stock to fifo queue
-			self.__adjust_incoming_transfer_qty(transfer_data, fifo_queue, row)
+			self.__adjust_incoming_transfer_qty(transfer_data, fifo_queue, row, actual_qty)
+			if not transfer_data:
+				# drained
+				del self.transferred_item_details[transfer_key]
+				self.evicted_transfer_buckets += 1
 		else:
-			if not serial_nos and not row.get("has_serial_no"):
-				if fifo_queue and flt(fifo_queue[0][0]) <= 0:
+			if not serial_nos and not row.has_serial_no:
+				head = fifo_queue.head
+				if head and head.qty <= 0:
 					# neutralize 0/negative stock by adding positive stock
-					fifo_queue[0][0] += flt(row.actual_qty)
-					fifo_queue[0][1] = row.posting_date
+					head.qty += actual_qty
+					head.posting_date = row.posting_date
 				else:
-					fifo_queue.append([flt(row.actual_qty), row.posting_date])
+					fifo_queue.append(FIFOSlot(actual_qty, row.posting_date))
 				return
 
 			for serial_no in serial_nos:
 				if self.serial_no_batch_purchase_details.get(serial_no):
-					fifo_queue.append([serial_no, self.serial_no_batch_purchase_details.get(serial_no)])
+					fifo_queue.add_serial_no(serial_no, self.serial_no_batch_purchase_details.get(serial_no))
 				else:
 					self.serial_no_batch_purchase_details.setdefault(serial_no, row.posting_date)
-					fifo_queue.append([serial_no, row.posting_date])
+					fifo_queue.add_serial_no(serial_no, row.posting_date)
 
 	def __compute_outgoing_stock(
-		self, row: Dict, fifo_queue: List, transfer_key: Tuple, serial_nos: List
+		self,
+		row: SLERow,
+		actual_qty: float,
+		fifo_queue: FIFOSlotQueue,
+		transfer_key: Tuple,
+		serial_nos: List,
 	):
 		"Update FIFO Queue on outward stock."
 		if serial_nos:
-			fifo_queue[:] = [serial_no for serial_no in fifo_queue if serial_no[0] not in serial_nos]
+			fifo_queue.remove_serial_nos(serial_nos)
+			return
+
+		qty_to_pop = abs(actual_qty)
+		if not qty_to_pop:
 			return
 
-		qty_to_pop = abs(row.actual_qty)
+		transfer_data = self.__get_transfer_bucket(transfer_key)
 		while qty_to_pop:
-			slot = fifo_queue[0] if fifo_queue else [0, None]
-			if 0 < flt(slot[0]) <= qty_to_pop:
+			slot = fifo_queue.head
+			if slot and 0 < slot.qty <= qty_to_pop:
 				# qty to pop >= slot qty
 				# if +ve and not enough or exactly same balance in current slot, consume whole slot
-				qty_to_pop -= flt(slot[0])
-				self.transferred_item_details[transfer_key].append(fifo_queue.pop(0))
-			elif not fifo_queue:
+				qty_to_pop -= slot.qty
+				transfer_data.append(fifo_queue.popleft())
+			elif not slot:
 				# negative stock, no balance but qty yet to consume
-				fifo_queue.append([-(qty_to_pop), row.posting_date])
-				self.transferred_item_details[transfer_key].append([qty_to_pop, row.posting_date])
+				fifo_queue.append(FIFOSlot(-(qty_to_pop), row.posting_date))
+				transfer_data.append(FIFOSlot(qty_to_pop, row.posting_date))
 				qty_to_pop = 0
 			else:
 				# qty to pop < slot qty, ample balance
 				# consume actual_qty from first slot
-				slot[0] = flt(slot[0]) - qty_to_pop
-				self.transferred_item_details[transfer_key].append([qty_to_pop, slot[1]])
+				slot.qty -= qty_to_pop
+				transfer_data.append(FIFOSlot(qty_to_pop, slot.posting_date))
 				qty_to_pop = 0
 
-	def __adjust_incoming_transfer_qty(self, transfer_data: Dict, fifo_queue: List, row: Dict):
+	def __adjust_incoming_transfer_qty(
+		self, transfer_data: deque, fifo_queue: FIFOSlotQueue, row: SLERow, actual_qty: float
+	):
 		"Add previously removed stock back to FIFO Queue."
-		transfer_qty_to_pop = flt(row.actual_qty)
+		transfer_qty_to_pop = actual_qty
 
 		def add_to_fifo_queue(slot):
-			if fifo_queue and flt(fifo_queue[0][0]) <= 0:
+			head = fifo_queue.head
+			if head and head.qty <= 0:
 				# neutralize 0/negative stock by adding positive stock
-				fifo_queue[0][0] += flt(slot[0])
-				fifo_queue[0][1] = slot[1]
+				head.qty += slot.qty
+				head.posting_date = slot.posting_date
 			else:
 				fifo_queue.append(slot)
 
 		while transfer_qty_to_pop:
-			if transfer_data and 0 < transfer_data[0][0] <= transfer_qty_to_pop:
+			if transfer_data and 0 < transfer_data[0].qty <= transfer_qty_to_pop:
 				# bucket qty is not enough, consume whole
-				transfer_qty_to_pop -= transfer_data[0][0]
-				add_to_fifo_queue(transfer_data.pop(0))
+				transfer_qty_to_pop -= transfer_data[0].qty
+				add_to_fifo_queue(transfer_data.popleft())
 			elif not transfer_data:
 				# transfer bucket is empty, extra incoming qty
-				add_to_fifo_queue([transfer_qty_to_pop, row.posting_date])
+				add_to_fifo_queue(FIFOSlot(transfer_qty_to_pop, row.posting_date))
 				transfer_qty_to_pop = 0
 			else:
 				# ample bucket qty to consume
-				transfer_data[0][0] -= transfer_qty_to_pop
-				add_to_fifo_queue([transfer_qty_to_pop, transfer_data[0][1]])
+				transfer_data[0].qty -= transfer_qty_to_pop
+				add_to_fifo_queue(FIFOSlot(transfer_qty_to_pop, transfer_data[0].posting_date))
 				transfer_qty_to_pop = 0
 
-	def __update_balances(self, row: Dict, key: Union[Tuple, str]):
-		self.item_details[key]["qty_after_transaction"] = row.qty_after_transaction
+	def __update_balances(
+		self, row: SLERow, actual_qty: int, qty_after_transaction: int, key: Union[Tuple, str]
+	):
+		self.item_details[key]["qty_after_transaction"] = qty_after_transaction
 
 		if "total_qty" not in self.item_details[key]:
-			self.item_details[key]["total_qty"] = row.actual_qty
+			self.item_details[key]["total_qty"] = actual_qty
 		else:
-			self.item_details[key]["total_qty"] += row.actual_qty
+			self.item_details[key]["total_qty"] += actual_qty
 
 		self.item_details[key]["has_serial_no"] = row.has_serial_no
 
-	def __aggregate_details_by_item(self, wh_wise_data: Dict) -> Dict:
-		"Aggregate Item-Wh wise data into single Item entry."
-		item_aggregated_data = {}
-		for key, row in wh_wise_data.items():
-			item = key[0]
-			if not item_aggregated_data.get(item):
-				item_aggregated_data.setdefault(
-					item,
-					{"details": frappe._dict(), "fifo_queue": [], "qty_after_transaction": 0.0, "total_qty": 0.0},
-				)
-			item_row = item_aggregated_data.get(item)
-			item_row["details"].update(row["details"])
-			item_row["fifo_queue"].extend(row["fifo_queue"])
-			item_row["qty_after_transaction"] += flt(row["qty_after_transaction"])
-			item_row["total_qty"] += flt(row["total_qty"])
-			item_row["has_serial_no"] = row["has_serial_no"]
-
-		return item_aggregated_data
-
-	def __get_stock_ledger_entries(self) -> List[Dict]:
-		sle = frappe.qb.DocType("Stock Ledger Entry")
-		item = self.__get_item_query()  # used as derived table in sle query
-
-		sle_query = (
-			frappe.qb.from_(sle)
-			.from_(item)
-			.select(
-				item.name,
-				item.item_name,
-				item.item_group,
-				item.brand,
-				item.description,
-				item.stock_uom,
-				item.has_serial_no,
-				sle.actual_qty,
-				sle.posting_date,
-				sle.voucher_type,
-				sle.voucher_no,
-				sle.serial_no,
-				sle.batch_no,
-				sle.qty_after_transaction,
-				sle.warehouse,
+	def __get_as_on_date(self):
+		"Earliest date FIFO Queues are needed as on."
+		return self.snapshot_dates[0] if self.snapshot_dates else getdate(self.filters.get("to_date"))
+
+	def __load_checkpoint(self) -> Optional[date]:
+		"""
+		Load FIFO Queues and serial no purchase dates from the latest Stock Ageing Checkpoint
+		on or before the as on date. Returns the checkpoint date, entries after it are replayed.
+		"""
+		if self.filters.get("ignore_checkpoint"):
+			return None
+
+		company = self.filters.get("company")
+		checkpoints = frappe.get_all(
+			"Stock Ageing Checkpoint",
+			filters={"company": company, "checkpoint_date": ("<=", self.__get_as_on_date())},
+			fields=["name", "creation", "checkpoint_date"],
+			order_by="checkpoint_date desc",
+		)
+
+		# a back-dated change deletes later checkpoints in a job queued after it commits,
+		# until that job runs they are skipped here
+		checkpoint = next(
+			(
+				d
+				for d in checkpoints
+				if not is_ledger_changed_since(company, d.checkpoint_date, d.creation)
+			),
+			None,
+		)
+		if not checkpoint:
+			return None
+
+		conditions, values = get_item_warehouse_conditions(self.filters, "queue")
+		conditions.insert(0, "queue.checkpoint = %(checkpoint)s")
+		values["checkpoint"] = checkpoint.name
+
+		if self.batch_wise:
+			conditions.append(f"not ({BATCH_ITEM_CONDITION})")
+
+		queues = frappe.db.sql(
+			f"""
+			select
+				queue.item_code as name, item.has_serial_no, queue.warehouse,
+				queue.qty_after_transaction, queue.total_qty, queue.fifo_queue
+			from `tabStock Ageing Checkpoint Queue` queue
+			inner join `tabItem` item on item.name = queue.item_code
+			where {" and ".join(conditions)}
+			""",
+			values,
+			as_dict=True,
+		)
+
+		dates, scale = {}, self.scale
+
+		def get_slot(slot):
+			qty, posting_date = slot[0], dates.get(slot[1])
+			if posting_date is None:
+				posting_date = dates[slot[1]] = getdate(slot[1])
+
+			# Serial No slots hold the serial no as qty
+			return FIFOSlot(qty if isinstance(qty, str) else round(flt(qty) * scale), posting_date)
+
+		for row in queues:
+			self.item_details[(row.name, row.warehouse)] = {
+				"details": row,
+				"fifo_queue": FIFOSlotQueue(map(get_slot, json.loads(row.pop("fifo_queue")))),
+				"qty_after_transaction": round(flt(row.pop("qty_after_transaction")) * scale),
+				"total_qty": round(flt(row.pop("total_qty")) * scale),
+				"has_serial_no": row.has_serial_no,
+			}
+
+		serial_no_purchase_dates = frappe.db.get_value(
+			"Stock Ageing Checkpoint", checkpoint.name, "serial_no_purchase_dates"
+		)
+		for serial_no, posting_date in json.loads(serial_no_purchase_dates or "{}").items():
+			self.serial_no_batch_purchase_details[serial_no] = getdate(posting_date)
+
+		return checkpoint.checkpoint_date
+
+	def __load_batch_queues(self):
+		"""
+		Load FIFO Queues of batch items from batch balances as on the to date, one slot per batch
+		aged from the first inward date of the batch in the warehouse, so stock transferred in is
+		aged from its arrival as in the replay. Entries without a batch are aged as one batch.
+
+		Matches the replay when batches are consumed oldest first and each batch is received
+		into a warehouse at once. Otherwise the ages of the batches actually in stock are used,
+		`replay_batch_items` ages batch items by the FIFO replay instead.
+		"""
+		conditions, values = get_sle_conditions(self.filters)
+
+		batches = frappe.db.sql(
+			f"""
+			with balances as (
+				select
+					sle.item_code, sle.warehouse, ifnull(sle.batch_no, '') as batch_no,
+					sum(sle.actual_qty) as balance_qty,
+					coalesce(
+						min(case when sle.actual_qty > 0 then sle.posting_date end), min(sle.posting_date)
+					) as batch_date
+				from `tabStock Ledger Entry` sle
+				inner join `tabItem` item on item.name = sle.item_code
+				where {conditions} and {BATCH_ITEM_CONDITION}
+				group by sle.item_code, sle.warehouse, ifnull(sle.batch_no, '')
 			)
-			.where(
-				(sle.item_code == item.name)
-				& (sle.company == self.filters.get("company"))
-				& (sle.posting_date <= self.filters.get("to_date"))
-				& (sle.is_cancelled != 1)
+			select
+				balances.item_code as name, item.has_serial_no, balances.warehouse, balances.balance_qty,
+				balances.batch_date
+			from balances
+			inner join `tabItem` item on item.name = balances.item_code
+			order by batch_date, balances.batch_no
+			""",
+			values,
+			as_dict=True,
+		)
+
+		for row in batches:
+			balance_qty = round(flt(row.pop("balance_qty")) * self.scale)
+			batch_date = row.pop("batch_date")
+			if not balance_qty:
+				continue
+
+			item_dict = self.item_details.setdefault(
+				(row.name, row.warehouse),
+				{
+					"details": row,
+					"fifo_queue": FIFOSlotQueue(),
+					"qty_after_transaction": 0,
+					"total_qty": 0,
+					"has_serial_no": row.has_serial_no,
+				},
+			)
+			item_dict["fifo_queue"].append(FIFOSlot(balance_qty, batch_date))
+			item_dict["qty_after_transaction"] += balance_qty
+			item_dict["total_qty"] += balance_qty
+
+	def __get_stock_ledger_entries(self, checkpoint_date: date = None) -> Iterator[SLERow]:
+		"""
+		Returns entries to replay in posting order.
+
+		FIFO Queue of a non serial (item, warehouse) is empty again each time its stock goes
+		from positive to zero, so only the entries after its latest such zero crossing are fetched.
+		Zero crossings in the middle of a voucher are skipped, its inward rows may still
+		need the transfer bucket built from the outward rows.
+
+		Rows are streamed from an unbuffered cursor as `SLERow` tuples, so memory held
+		by the replay scales with the open FIFO slots and not with the size of the ledger.
+		The cursor stays open until the last row is read, the caller must not query the
+		database while iterating.
+		"""
+		conditions, values = get_sle_conditions(self.filters)
+
+		if checkpoint_date:
+			# replay continues from the state loaded from the Stock Ageing Checkpoint,
+			# zero crossings after it would drop that state so they are not used
+			conditions += " and sle.posting_date > %(checkpoint_date)s"
+			values.update({"checkpoint_date": checkpoint_date, "zero_stock_date": None})
+		else:
+			# snapshots need the entries before the first snapshot date
+			values["zero_stock_date"] = self.__get_as_on_date()
+
+		if self.batch_wise:
+			conditions += f" and not ({BATCH_ITEM_CONDITION})"
+
+		query = f"""
+			with entries as (
+				select
+					sle.item_code as name, item.has_serial_no, sle.actual_qty, sle.posting_date,
+					sle.posting_time, sle.creation, sle.voucher_type, sle.voucher_no, sle.serial_no,
+					sle.batch_no, sle.qty_after_transaction, sle.warehouse,
+					row_number() over (
+						partition by sle.item_code, sle.warehouse
+						order by sle.posting_date, sle.posting_time, sle.creation, sle.actual_qty
+					) as idx,
+					coalesce(lag(sle.qty_after_transaction) over (
+						partition by sle.item_code, sle.warehouse
+						order by sle.posting_date, sle.posting_time, sle.creation, sle.actual_qty
+					), 0) as prev_qty_after_transaction,
+					lead(sle.voucher_no) over (
+						partition by sle.item_code, sle.warehouse
+						order by sle.posting_date, sle.posting_time, sle.creation, sle.actual_qty
+					) as next_voucher_no
+				from `tabStock Ledger Entry` sle
+				inner join `tabItem` item on item.name = sle.item_code
+				where {conditions}
 			)
+			select
+				entries.name, entries.has_serial_no, entries.actual_qty, entries.posting_date,
+				entries.voucher_type, entries.voucher_no, entries.serial_no, entries.batch_no,
+				entries.qty_after_transaction, entries.warehouse
+			from entries
+			left join (
+				select name, warehouse, max(idx) as idx
+				from entries
+				where
+					qty_after_transaction = 0
+					and prev_qty_after_transaction > 0
+					and posting_date <= %(zero_stock_date)s
+					and has_serial_no = 0
+					and (next_voucher_no is null or next_voucher_no != voucher_no)
+				group by name, warehouse
+			) checkpoint on checkpoint.name = entries.name and checkpoint.warehouse = entries.warehouse
+			where entries.idx > coalesce(checkpoint.idx, 0)
+			order by entries.posting_date, entries.posting_time, entries.creation, entries.actual_qty
+		"""
+
+		with frappe.db.unbuffered_cursor():
+			for row in frappe.db.sql(query, values, as_iterator=True):
+				yield SLERow._make(row)
+
+
+class ParallelFIFOSlots:
+	"""
+	Replays `FIFOSlots` in worker processes, one partition of items per worker.
+
+	FIFO state is independent per item (transfer buckets are keyed by item and serial nos
+	belong to one item), so items are split by a hash of the item code. Each worker fetches
+	and replays its own partition and the results are merged per (item, warehouse).
+
+	Each worker opens its own database connection, so the number of workers is capped by
+	`stock_ageing_workers` in site config (default 2, at most the CPU count) and only one
+	parallel replay runs on a site at a time, other runs replay serially. Item sets smaller
+	than `PARALLEL_REPLAY_MIN_ITEMS` are replayed serially as well.
+	"""
+
+	def __init__(self, filters: Dict = None, sle: List = None):
+		self.filters = filters
+		self.sle = sle
+		self.workers = min(
+			cint(frappe.conf.get("stock_ageing_workers")) or DEFAULT_STOCK_AGEING_WORKERS,
+			os.cpu_count() or 1,
 		)
 
-		if self.filters.get("warehouse"):
-			sle_query = self.__get_warehouse_conditions(sle, sle_query)
+	def generate(self) -> Dict:
+		"Returns dict of the same structure as `FIFOSlots.generate`."
+		if not self.use_workers():
+			return FIFOSlots(self.filters, self.sle).generate()
+
+		filters = frappe._dict(self.filters)
+		filters.show_warehouse_wise_stock = True
 
-		sle_query = sle_query.orderby(sle.posting_date, sle.posting_time, sle.creation, sle.actual_qty)
+		item_details = {}
+		for partition_details in self.replay_partitions(filters):
+			item_details.update(partition_details)
 
-		return sle_query.run(as_dict=True)
+		if not self.filters.get("show_warehouse_wise_stock"):
+			# (Item 1, WH 1), (Item 1, WH 2) => (Item 1)
+			item_details = aggregate_details_by_item(item_details)
 
-	def __get_item_query(self) -> str:
-		item_table = frappe.qb.DocType("Item")
+		return item_details
 
-		item = frappe.qb.from_("Item").select(
-			"name", "item_name", "description", "stock_uom", "brand", "item_group", "has_serial_no"
+	def use_workers(self) -> bool:
+		return (
+			self.sle is None
+			and self.workers > 1
+			and self.get_item_count() >= PARALLEL_REPLAY_MIN_ITEMS
 		)
 
+	def get_item_count(self) -> int:
+		"Items stocked in the company's warehouses, a parallel replay only pays off for many items."
 		if self.filters.get("item_code"):
-			item = item.where(item_table.item_code == self.filters.get("item_code"))
+			return 1
+
+		return frappe.db.sql(
+			"""
+			select count(distinct bin.item_code)
+			from `tabBin` bin
+			inner join `tabWarehouse` warehouse on warehouse.name = bin.warehouse
+			where warehouse.company = %s
+			""",
+			self.filters.get("company"),
+		)[0][0]
+
+	def replay_partitions(self, filters: Filters) -> Iterator[Dict]:
+		"Yields the (item, warehouse) wise FIFO Queues of each partition, replayed by the workers."
+		cache = frappe.cache()
+		lock = cache.lock(cache.make_key("stock_ageing_parallel_replay"), timeout=PARALLEL_REPLAY_LOCK_TIMEOUT)
+
+		if not lock.acquire(blocking=False):
+			# another report run holds the workers
+			yield FIFOSlots(filters).generate()
+			return
+
+		try:
+			with ProcessPoolExecutor(
+				max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+			) as executor:
+				partitions = [
+					executor.submit(
+						replay_fifo_slots_partition,
+						frappe.local.site,
+						frappe.local.sites_path,
+						filters,
+						partition,
+						self.workers,
+					)
+					for partition in range(self.workers)
+				]
+
+				for partition in partitions:
+					yield partition.result()
+		finally:
+			if lock.owned():
+				lock.release()
+
+
+def replay_fifo_slots_partition(
+	site: str, sites_path: str, filters: Filters, partition: int, partitions: int
+) -> Dict:
+	"Runs in a `ParallelFIFOSlots` worker process with its own site connection."
+	frappe.init(site=site, sites_path=sites_path)
+	frappe.connect()
+
+	try:
+		filters.update({"partition": partition, "partitions": partitions})
+		return FIFOSlots(filters).generate()
+	finally:
+		frappe.destroy()
+
+
+def aggregate_details_by_item(wh_wise_data: Dict) -> Dict:
+	"Aggregate Item-Wh wise data into single Item entry."
+	item_aggregated_data = {}
+	for key, row in wh_wise_data.items():
+		item = key[0]
+		if not item_aggregated_data.get(item):
+			item_aggregated_data.setdefault(
+				item,
+				{
+					"details": None,
+					"fifo_queue": FIFOSlotQueue(),
+					"qty_after_transaction": 0.0,
+					"total_qty": 0.0,
+					"warehouses": [],
+				},
+			)
+		item_row = item_aggregated_data.get(item)
+		item_row["details"] = row["details"]
+		item_row["warehouses"].append(key[1])
+		item_row["fifo_queue"].extend(row["fifo_queue"])
+		item_row["qty_after_transaction"] += flt(row["qty_after_transaction"])
+		item_row["total_qty"] += flt(row["total_qty"])
+		item_row["has_serial_no"] = row["has_serial_no"]
+
+	return item_aggregated_data
+
+
+def get_sle_conditions(filters: Filters) -> Tuple[str, Dict]:
+	"Returns SQL conditions on `sle` and `item` for the report filters."
+	conditions, values = get_item_warehouse_conditions(filters, "sle")
+	conditions = [
+		"sle.company = %(company)s",
+		"sle.posting_date <= %(to_date)s",
+		"sle.is_cancelled = 0",
+	] + conditions
+	values.update({"company": filters.get("company"), "to_date": filters.get("to_date")})
+
+	return " and ".join(conditions), values
+
+
+def get_item_warehouse_conditions(filters: Filters, table: str) -> Tuple[List[str], Dict]:
+	"Returns item and warehouse filter conditions on `item` and `table` (having item_code, warehouse)."
+	conditions, values = [], {}
+
+	if filters.get("item_code"):
+		conditions.append("item.item_code = %(item_code)s")
+		values["item_code"] = filters.get("item_code")
+
+	if filters.get("brand"):
+		conditions.append("item.brand = %(brand)s")
+		values["brand"] = filters.get("brand")
+
+	if filters.get("has_serial_no"):
+		conditions.append("item.has_serial_no = 1")
+
+	if filters.get("warehouse"):
+		conditions.append(f"{table}.warehouse in %(warehouses)s")
+		values["warehouses"] = get_warehouses(filters.get("warehouse"))
+
+	if filters.get("partitions"):
+		# item wise partition replayed by a `ParallelFIFOSlots` worker
+		conditions.append(f"mod(crc32({table}.item_code), %(partitions)s) = %(partition)s")
+		values.update({"partitions": filters.get("partitions"), "partition": filters.get("partition")})
+
+	return conditions, values
 
-		if self.filters.get("brand"):
-			item = item.where(item_table.brand == self.filters.get("brand"))
 
-		return item
+def is_ledger_changed_since(company: str, to_date, timestamp) -> bool:
+	"Ledger entries up to `to_date` posted or cancelled after `timestamp`."
+	return bool(
+		frappe.db.exists(
+			"Stock Ledger Entry",
+			{"company": company, "posting_date": ("<=", to_date), "modified": (">=", timestamp)},
+		)
+	)
+
+
+def get_warehouses(parent_warehouse: str) -> List[str]:
+	"Returns the warehouse along with all its descendants."
+	warehouse = frappe.qb.DocType("Warehouse")
+	lft, rgt = frappe.db.get_value("Warehouse", parent_warehouse, ["lft", "rgt"])
+
+	warehouse_results = (
+		frappe.qb.from_(warehouse)
+		.select("name")
+		.where((warehouse.lft >= lft) & (warehouse.rgt <= rgt))
+		.run()
+	)
+	return [x[0] for x in warehouse_results]
+
+
+class ReverseFIFOSlots:
+	"""
+	Returns the same FIFO slots as `FIFOSlots` without replaying the ledger from the beginning.
+
+	Under FIFO the stock on hand is always made of the most recent inward quantities adding
+	up to the balance, so inward entries are walked newest first from the balance at `to_date`
+	and the walk stops as soon as the balance is covered. Serial No items are still replayed
+	via `FIFOSlots`. Stock moved out and back in by the same voucher (eg: Repack with same item)
+	is aged from the voucher date and keys with a negative balance have no slots.
+
+	Item level ageing therefore differs from `FIFOSlots` when a warehouse of the item has a
+	negative balance: the replay keeps a negative slot that offsets the other warehouses,
+	here only the stock of warehouses with a positive balance is aged.
+	"""
+
+	def __init__(self, filters: Dict = None, sle: List = None):
+		self.item_details = {}
+		self.filters = filters
+		self.sle = sle
 
-	def __get_warehouse_conditions(self, sle, sle_query) -> str:
-		warehouse = frappe.qb.DocType("Warehouse")
-		lft, rgt = frappe.db.get_value("Warehouse", self.filters.get("warehouse"), ["lft", "rgt"])
+	def generate(self) -> Dict:
+		"Returns dict of the same structure as `FIFOSlots.generate`."
+		if self.sle is None:
+			inward_details = self.__get_inward_entries()
+			serial_item_sle = None
+		else:
+			inward_details, serial_item_sle = self.__get_inward_entries_from_sle()
+
+		precision = get_float_precision()
+		for key, row in inward_details.items():
+			self.item_details[key] = {
+				"details": row["details"],
+				"fifo_queue": self.__get_fifo_queue(row["balance_qty"], row["inward_entries"], precision),
+				"qty_after_transaction": row["balance_qty"],
+				"total_qty": row["balance_qty"],
+				"has_serial_no": 0,
+			}
+
+		if serial_item_sle is None or serial_item_sle:
+			# serial nos are aged by their own purchase date, replay them
+			serial_item_filters = frappe._dict(self.filters)
+			serial_item_filters.update({"show_warehouse_wise_stock": True, "has_serial_no": 1})
+			self.item_details.update(FIFOSlots(serial_item_filters, serial_item_sle).generate())
 
-		warehouse_results = (
-			frappe.qb.from_(warehouse)
-			.select("name")
-			.where((warehouse.lft >= lft) & (warehouse.rgt <= rgt))
-			.run()
+		if not self.filters.get("show_warehouse_wise_stock"):
+			# (Item 1, WH 1), (Item 1, WH 2) => (Item 1)
+			self.item_details = aggregate_details_by_item(self.item_details)
+
+		return self.item_details
+
+	@staticmethod
+	def __get_fifo_queue(balance_qty: float, inward_entries: List, precision: int) -> FIFOSlotQueue:
+		"Build FIFO Queue from inward entries (newest first) until balance qty is covered."
+		fifo_queue = FIFOSlotQueue()
+		qty_to_cover = flt(balance_qty)
+
+		for qty, posting_date in inward_entries:
+			if flt(qty_to_cover, precision) <= 0:
+				break
+
+			slot_qty = min(flt(qty), qty_to_cover)
+			fifo_queue.appendleft(FIFOSlot(slot_qty, posting_date))
+			qty_to_cover -= slot_qty
+
+		return fifo_queue
+
+	def __get_inward_entries_from_sle(self) -> Tuple[Dict, List]:
+		"Walk the given entries (in posting order) to get balances and inward entries per key."
+		inward_details, serial_item_sle = {}, []
+
+		for d in self.sle:
+			if d.has_serial_no or d.serial_no:
+				serial_item_sle.append(d)
+				continue
+
+			key = (d.name, d.warehouse)
+			if key not in inward_details:
+				inward_details[key] = {
+					"details": frappe._dict(name=d.name, warehouse=d.warehouse),
+					"balance_qty": 0.0,
+					"inward_entries": [],
+				}
+
+			key_details = inward_details[key]
+			if d.voucher_type == "Stock Reconciliation":
+				# get difference in qty shift as actual qty
+				inward_qty = flt(d.qty_after_transaction) - flt(key_details["balance_qty"])
+			else:
+				inward_qty = flt(d.actual_qty)
+
+			if inward_qty > 0:
+				key_details["inward_entries"].append((inward_qty, d.posting_date))
+
+			key_details["balance_qty"] = flt(d.qty_after_transaction)
+
+		for key_details in inward_details.values():
+			key_details["inward_entries"].reverse()
+
+		return inward_details, serial_item_sle
+
+	def __get_inward_entries(self) -> Dict:
+		"""
+		Fetch only the inward entries needed to cover the balance of each non serial (item, warehouse).
+		Running inward qty (newest first) is computed in the database, so fully consumed
+		receipts are never sent over.
+		"""
+		conditions, values = get_sle_conditions(self.filters)
+
+		entries = frappe.db.sql(
+			f"""
+			select name, warehouse, posting_date, inward_qty, balance_qty
+			from (
+				select
+					entries.*,
+					sum(inward_qty) over (
+						partition by name, warehouse
+						order by idx desc
+						rows between unbounded preceding and current row
+					) as covered_qty
+				from (
+					select
+						sle.item_code as name, sle.warehouse, sle.posting_date,
+						row_number() over (
+							partition by sle.item_code, sle.warehouse
+							order by sle.posting_date, sle.posting_time, sle.creation, sle.actual_qty
+						) as idx,
+						if(sle.voucher_type = 'Stock Reconciliation',
+							sle.qty_after_transaction - coalesce(lag(sle.qty_after_transaction) over (
+								partition by sle.item_code, sle.warehouse
+								order by sle.posting_date, sle.posting_time, sle.creation, sle.actual_qty
+							), 0),
+							sle.actual_qty
+						) as inward_qty,
+						first_value(sle.qty_after_transaction) over (
+							partition by sle.item_code, sle.warehouse
+							order by sle.posting_date desc, sle.posting_time desc, sle.creation desc,
+								sle.actual_qty desc
+						) as balance_qty
+					from `tabStock Ledger Entry` sle
+					inner join `tabItem` item on item.name = sle.item_code
+					where {conditions} and item.has_serial_no = 0
+				) entries
+				where inward_qty > 0 and balance_qty > 0
+			) inward_entries
+			where covered_qty - inward_qty < balance_qty
+			order by name, warehouse, covered_qty
+			""",
+			values,
+			as_dict=True,
 		)
-		warehouse_results = [x[0] for x in warehouse_results]
 
-		return sle_query.where(sle.warehouse.isin(warehouse_results))
+		inward_details = {}
+		for d in entries:
+			key = (d.name, d.warehouse)
+			if key not in inward_details:
+				inward_details[key] = {
+					"details": frappe._dict(name=d.name, warehouse=d.warehouse),
+					"balance_qty": flt(d.balance_qty),
+					"inward_entries": [],
+				}
+
+			inward_details[key]["inward_entries"].append((flt(d.inward_qty), d.posting_date))
+
+		return inward_details
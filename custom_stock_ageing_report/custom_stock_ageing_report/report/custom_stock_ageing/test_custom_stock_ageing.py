@@ -0,0 +1,822 @@
+# Copyright (c) 2024, sushant and contributors
+# For license information, please see license.txt
+
+import tracemalloc
+import zlib
+from datetime import date, timedelta
+from operator import itemgetter
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+from frappe.utils import getdate
+
+from custom_stock_ageing_report.custom_stock_ageing_report.report.custom_stock_ageing.custom_stock_ageing import (
+	PARALLEL_REPLAY_MIN_ITEMS,
+	AgeingRollup,
+	FIFOSlots,
+	ParallelFIFOSlots,
+	ReverseFIFOSlots,
+	SLERow,
+	format_report_data,
+	get_ageing_boundaries,
+	get_ageing_data,
+	get_ageing_snapshot,
+	get_chart_data,
+	get_item_wise_chart_data,
+	get_average_age,
+	get_price_list_rates,
+	get_snapshot_data,
+	setup_ageing_columns,
+)
+
+
+class TestCustomStockAgeing(FrappeTestCase):
+	def setUp(self) -> None:
+		self.filters = frappe._dict(
+			company="_Test Company",
+			to_date="2021-12-10",
+			range1=30,
+			range2=60,
+			range3=90,
+			show_warehouse_wise_stock=True,
+		)
+
+	def get_sle(self, entries):
+		"entries: (actual_qty, qty_after_transaction, posting_date, voucher_type, voucher_no[, warehouse])"
+		sle = []
+		for entry in entries:
+			actual_qty, qty_after_transaction, posting_date, voucher_type, voucher_no = entry[:5]
+			sle.append(
+				frappe._dict(
+					name="Flask Item",
+					actual_qty=actual_qty,
+					qty_after_transaction=qty_after_transaction,
+					warehouse=entry[5] if len(entry) > 5 else "WH 1",
+					posting_date=posting_date,
+					voucher_type=voucher_type,
+					voucher_no=voucher_no,
+					has_serial_no=False,
+					serial_no=None,
+				)
+			)
+
+		return sle
+
+	def get_ledger_entries(self, item_code):
+		"Every ledger entry of `item_code` in posting order, as streamed to the replay."
+		return frappe.db.sql(
+			"""
+			select
+				sle.item_code as name, item.has_serial_no, sle.actual_qty, sle.posting_date,
+				sle.voucher_type, sle.voucher_no, sle.serial_no, sle.batch_no,
+				sle.qty_after_transaction, sle.warehouse
+			from `tabStock Ledger Entry` sle
+			inner join `tabItem` item on item.name = sle.item_code
+			where sle.item_code = %s and sle.is_cancelled = 0
+			order by sle.posting_date, sle.posting_time, sle.creation, sle.actual_qty
+			""",
+			item_code,
+			as_dict=True,
+		)
+
+	def get_ageing_buckets(self, item_details):
+		_func = itemgetter(1)
+		boundaries = get_ageing_boundaries(self.filters)
+		buckets = {}
+		for key, item_dict in item_details.items():
+			fifo_queue = sorted(filter(_func, item_dict["fifo_queue"]), key=_func)
+			ageing_data = get_ageing_data(fifo_queue, self.filters.to_date, boundaries, 3)
+			buckets[key] = (
+				ageing_data.range_qty if ageing_data else None,
+				get_average_age(fifo_queue, self.filters.to_date),
+				round(item_dict["total_qty"], 3),
+			)
+
+		return buckets
+
+	def assert_engines_match(self, entries):
+		replay = FIFOSlots(self.filters, self.get_sle(entries)).generate()
+		reverse = ReverseFIFOSlots(self.filters, self.get_sle(entries)).generate()
+
+		self.assertEqual(self.get_ageing_buckets(replay), self.get_ageing_buckets(reverse))
+		return reverse
+
+	def test_reverse_fifo_receipts_and_issues(self):
+		item_details = self.assert_engines_match(
+			[
+				(30, 30, "2021-08-01", "Stock Entry", "001"),
+				(20, 50, "2021-09-15", "Stock Entry", "002"),
+				(-35, 15, "2021-10-01", "Stock Entry", "003"),
+				(10, 25, "2021-11-20", "Stock Entry", "004"),
+				(-5, 20, "2021-12-01", "Stock Entry", "005"),
+			]
+		)
+
+		queue = item_details[("Flask Item", "WH 1")]["fifo_queue"]
+		self.assertEqual(list(queue), [[10.0, "2021-09-15"], [10.0, "2021-11-20"]])
+
+	def test_reverse_fifo_negative_stock(self):
+		self.assert_engines_match(
+			[
+				(5, 5, "2021-08-01", "Stock Entry", "001"),
+				(-10, -5, "2021-09-01", "Stock Entry", "002"),
+				(3, -2, "2021-10-01", "Stock Entry", "003"),
+				(8, 6, "2021-11-01", "Stock Entry", "004"),
+				(4, 10, "2021-12-01", "Stock Entry", "005"),
+			]
+		)
+
+	def test_reverse_fifo_item_level_negative_warehouse(self):
+		"Item level, a warehouse with negative stock offsets the others only in the replay."
+		self.filters.show_warehouse_wise_stock = False
+		entries = [
+			(10, 10, "2021-08-01", "Stock Entry", "001", "WH 1"),
+			(-4, -4, "2021-09-01", "Stock Entry", "002", "WH 2"),
+		]
+
+		replay = FIFOSlots(self.filters, self.get_sle(entries)).generate()["Flask Item"]
+		reverse = ReverseFIFOSlots(self.filters, self.get_sle(entries)).generate()["Flask Item"]
+
+		self.assertEqual(replay["total_qty"], reverse["total_qty"])
+		self.assertEqual(
+			sorted(map(list, replay["fifo_queue"])), [[-4.0, "2021-09-01"], [10.0, "2021-08-01"]]
+		)
+		self.assertEqual(list(map(list, reverse["fifo_queue"])), [[10.0, "2021-08-01"]])
+
+	def test_reverse_fifo_stock_reconciliation(self):
+		self.assert_engines_match(
+			[
+				(30, 30, "2021-07-01", "Stock Entry", "001"),
+				(0, 50, "2021-08-01", "Stock Reconciliation", "002"),
+				(-10, 40, "2021-09-01", "Stock Entry", "003"),
+				(0, 12, "2021-10-01", "Stock Reconciliation", "004"),
+				(15, 27, "2021-11-01", "Stock Entry", "005"),
+			]
+		)
+
+	def test_reverse_fifo_item_wise_aggregation(self):
+		self.filters.show_warehouse_wise_stock = False
+		self.assert_engines_match(
+			[
+				(30, 30, "2021-06-01", "Stock Entry", "001", "WH 1"),
+				(20, 20, "2021-07-01", "Stock Entry", "002", "WH 2"),
+				(-25, 5, "2021-08-01", "Stock Entry", "003", "WH 1"),
+				(40, 60, "2021-09-01", "Stock Entry", "004", "WH 2"),
+				(-50, 10, "2021-11-01", "Stock Entry", "005", "WH 2"),
+			]
+		)
+
+	def test_replay_from_zero_stock_checkpoint(self):
+		"Replaying only the entries after the last positive to zero crossing gives the same ageing."
+		entries = [
+			(30, 30, "2021-06-01", "Stock Entry", "001"),
+			(-30, 0, "2021-07-01", "Stock Entry", "002"),
+			(20, 20, "2021-08-01", "Stock Entry", "003"),
+			(-20, 0, "2021-09-01", "Stock Entry", "004"),
+			(0, 15, "2021-10-01", "Stock Reconciliation", "005"),
+			(10, 25, "2021-11-01", "Stock Entry", "006"),
+			(-12, 13, "2021-11-15", "Stock Entry", "007"),
+		]
+
+		full_replay = FIFOSlots(self.filters, self.get_sle(entries)).generate()
+		checkpoint_replay = FIFOSlots(self.filters, self.get_sle(entries[4:])).generate()
+
+		self.assertEqual(
+			self.get_ageing_buckets(full_replay), self.get_ageing_buckets(checkpoint_replay)
+		)
+
+	def test_ledger_query_starts_after_zero_stock(self):
+		"The ledger query skips entries up to the last zero crossing, ageing matches a full replay."
+		from erpnext.stock.doctype.item.test_item import make_item
+		from erpnext.stock.doctype.stock_entry.stock_entry_utils import make_stock_entry
+
+		self.addCleanup(frappe.db.rollback)
+		item_code = make_item("_Test Zero Stock Ageing Item", {"is_stock_item": 1}).name
+		warehouse = "_Test Warehouse - _TC"
+
+		for posting_date, qty, source, target in (
+			("2021-06-01", 30, None, warehouse),
+			("2021-07-01", 30, warehouse, None),
+			("2021-08-01", 20, None, warehouse),
+			("2021-09-01", 20, warehouse, None),
+			("2021-10-01", 15, None, warehouse),
+			("2021-11-01", 10, None, warehouse),
+			("2021-11-15", 12, warehouse, None),
+		):
+			make_stock_entry(
+				item_code=item_code, source=source, target=target, qty=qty, rate=100, posting_date=posting_date
+			)
+
+		self.filters.update({"item_code": item_code, "ignore_checkpoint": 1})
+		fifo_slots = FIFOSlots(self.filters)
+		streamed = list(fifo_slots._FIFOSlots__get_stock_ledger_entries())
+		self.assertEqual(
+			[str(row.posting_date) for row in streamed], ["2021-10-01", "2021-11-01", "2021-11-15"]
+		)
+
+		full_replay = FIFOSlots(self.filters, self.get_ledger_entries(item_code)).generate()
+		self.assertEqual(
+			self.get_ageing_buckets(FIFOSlots(self.filters).generate()),
+			self.get_ageing_buckets(full_replay),
+		)
+
+	def test_stale_checkpoint_is_skipped(self):
+		"A checkpoint after a back-dated entry is not loaded before the queued job deletes it."
+		from erpnext.stock.doctype.item.test_item import make_item
+		from erpnext.stock.doctype.stock_entry.stock_entry_utils import make_stock_entry
+
+		from custom_stock_ageing_report.custom_stock_ageing_report.doctype.stock_ageing_checkpoint.stock_ageing_checkpoint import (
+			create_stock_ageing_checkpoint,
+		)
+
+		self.addCleanup(frappe.db.rollback)
+		item_code = make_item("_Test Checkpoint Ageing Item", {"is_stock_item": 1}).name
+		warehouse = "_Test Warehouse - _TC"
+
+		make_stock_entry(item_code=item_code, target=warehouse, qty=10, rate=100, posting_date="2021-06-01")
+		make_stock_entry(item_code=item_code, target=warehouse, qty=5, rate=100, posting_date="2021-08-01")
+		create_stock_ageing_checkpoint("_Test Company", getdate("2021-09-30"))
+
+		# deletion of the checkpoint is queued after commit, it does not run here
+		with patch.object(frappe, "enqueue"):
+			make_stock_entry(item_code=item_code, target=warehouse, qty=7, rate=100, posting_date="2021-07-01")
+
+		self.assertTrue(
+			frappe.db.exists(
+				"Stock Ageing Checkpoint", {"company": "_Test Company", "checkpoint_date": "2021-09-30"}
+			)
+		)
+
+		self.filters.item_code = item_code
+		item_details = FIFOSlots(self.filters).generate()
+		full_replay = FIFOSlots(frappe._dict(self.filters, ignore_checkpoint=1)).generate()
+
+		self.assertEqual(item_details[(item_code, warehouse)]["total_qty"], 22.0)
+		self.assertEqual(self.get_ageing_buckets(item_details), self.get_ageing_buckets(full_replay))
+
+	def test_stale_snapshot_is_not_served(self):
+		"The report runs live once a back-dated entry changes the ledger up to the snapshot date."
+		from erpnext.stock.doctype.item.test_item import make_item
+		from erpnext.stock.doctype.stock_entry.stock_entry_utils import make_stock_entry
+
+		from custom_stock_ageing_report.custom_stock_ageing_report.doctype.stock_ageing_snapshot.stock_ageing_snapshot import (
+			create_stock_ageing_snapshot,
+		)
+
+		self.addCleanup(frappe.db.rollback)
+		item_code = make_item("_Test Snapshot Ageing Item", {"is_stock_item": 1}).name
+		warehouse = "_Test Warehouse - _TC"
+
+		make_stock_entry(item_code=item_code, target=warehouse, qty=10, rate=100, posting_date="2021-06-01")
+		create_stock_ageing_snapshot("_Test Company", getdate("2021-09-30"))
+
+		self.filters.update({"to_date": "2021-09-30", "item_code": item_code})
+		# item code, item name, description, item group, brand, warehouse, qty
+		self.assertEqual(get_snapshot_data(self.filters)[0][6], 10.0)
+
+		# deletion of the snapshot is queued after commit, it does not run here
+		with patch.object(frappe, "enqueue"):
+			make_stock_entry(item_code=item_code, target=warehouse, qty=7, rate=100, posting_date="2021-07-01")
+
+		self.assertIsNone(get_snapshot_data(self.filters))
+
+	def test_fifo_slot_queue_serial_nos(self):
+		sle = [
+			frappe._dict(
+				name="Serial Item",
+				actual_qty=3,
+				qty_after_transaction=3,
+				warehouse="WH 1",
+				posting_date="2021-10-01",
+				voucher_type="Stock Entry",
+				voucher_no="001",
+				has_serial_no=True,
+				serial_no="SN-001\nSN-002\nSN-003",
+			),
+			frappe._dict(
+				name="Serial Item",
+				actual_qty=-1,
+				qty_after_transaction=2,
+				warehouse="WH 1",
+				posting_date="2021-11-01",
+				voucher_type="Delivery Note",
+				voucher_no="002",
+				has_serial_no=True,
+				serial_no="SN-002",
+			),
+		]
+
+		item_details = FIFOSlots(self.filters, sle).generate()
+		queue = item_details[("Serial Item", "WH 1")]["fifo_queue"]
+
+		self.assertEqual(list(queue), [["SN-001", "2021-10-01"], ["SN-003", "2021-10-01"]])
+		self.assertEqual(get_average_age(queue, self.filters.to_date), 70.0)
+
+	def test_ageing_data_matches_slot_wise_ageing(self):
+		item_details = FIFOSlots(
+			self.filters,
+			self.get_sle(
+				[
+					(10.125, 10.125, "2021-06-01", "Stock Entry", "001"),
+					(7.5, 17.625, "2021-09-10", "Stock Entry", "002"),
+					(-3.333, 14.292, "2021-10-01", "Stock Entry", "003"),
+					(2.25, 16.542, "2021-10-12", "Stock Entry", "004"),
+					(4, 20.542, "2021-11-10", "Stock Entry", "005"),
+					(1, 21.542, "2021-12-10", "Stock Entry", "006"),
+				]
+			),
+		).generate()
+
+		item_dict = item_details[("Flask Item", "WH 1")]
+		fifo_queue = sorted(item_dict["fifo_queue"], key=itemgetter(1))
+		to_date = self.filters.to_date
+
+		ageing_data = get_ageing_data(item_dict["fifo_queue"], to_date, [30, 60, 90], 3)
+
+		self.assertEqual(ageing_data.range_qty, [5.0, 2.25, 0.0, 14.292])
+		self.assertEqual(get_average_age(fifo_queue, to_date), ageing_data.average_age)
+		self.assertEqual(ageing_data.earliest_age, 192)
+		self.assertEqual(ageing_data.latest_age, 0)
+
+	def test_ageing_trend_snapshots(self):
+		"Snapshots of one replay match separate replays as on each date."
+		entries = [
+			(30, 30, "2021-08-01", "Stock Entry", "001"),
+			(20, 50, "2021-09-15", "Stock Entry", "002"),
+			(-35, 15, "2021-10-01", "Stock Entry", "003"),
+			(10, 25, "2021-11-20", "Stock Entry", "004"),
+			(-5, 20, "2021-12-01", "Stock Entry", "005"),
+		]
+		as_on_dates = [getdate("2021-09-30"), getdate("2021-10-31"), getdate("2021-12-10")]
+
+		fifo_slots = FIFOSlots(self.filters, self.get_sle(entries), snapshot_dates=as_on_dates)
+		fifo_slots.generate()
+
+		for as_on_date in as_on_dates:
+			sle = [d for d in self.get_sle(entries) if getdate(d.posting_date) <= as_on_date]
+			item_details = FIFOSlots(self.filters, sle).generate()
+			expected = get_ageing_snapshot(item_details, as_on_date, self.filters, 3)
+
+			self.assertEqual(fifo_slots.snapshots[as_on_date], expected)
+
+	def get_synthetic_sle(self, count):
+		"Balanced receipts and issues across 50 warehouses, 100 entries per day."
+		for i in range(count):
+			qty = 10 if i % 2 == 0 else -10
+			yield SLERow(
+				"Flask Item",
+				0,
+				qty,
+				date(2021, 1, 1) + timedelta(days=i // 100),
+				"Stock Entry",
+				f"SE-{i:06d}-" + "with a long remark " * 8,
+				None,
+				None,
+				10 if i % 2 == 0 else 0,
+				f"WH {i % 50}",
+			)
+
+	def get_peak_memory(self, sle):
+		tracemalloc.start()
+		try:
+			FIFOSlots(self.filters, sle()).generate()
+			return tracemalloc.get_traced_memory()[1]
+		finally:
+			tracemalloc.stop()
+
+	def test_streamed_entries_memory(self):
+		"Peak memory of a streamed replay is well below a replay of entries buffered as dicts."
+		count = 20000
+		streamed_peak = self.get_peak_memory(lambda: self.get_synthetic_sle(count))
+		buffered_peak = self.get_peak_memory(
+			lambda: [frappe._dict(row._asdict()) for row in self.get_synthetic_sle(count)]
+		)
+
+		self.assertLess(streamed_peak * 2, buffered_peak)
+
+	def test_no_queries_while_streaming_entries(self):
+		"Entries are streamed from an open unbuffered cursor, the replay must not query meanwhile."
+		streaming = False
+
+		def stream(rows):
+			nonlocal streaming
+			streaming = True
+			yield from rows
+			streaming = False
+
+		def guard(method):
+			def guarded(*args, **kwargs):
+				self.assertFalse(streaming, "database queried while streaming ledger entries")
+				return method(*args, **kwargs)
+
+			return guarded
+
+		with patch.object(frappe.db, "sql", guard(frappe.db.sql)), patch.object(
+			frappe.db, "get_single_value", guard(frappe.db.get_single_value)
+		):
+			fifo_slots = FIFOSlots(
+				self.filters,
+				stream(self.get_multi_item_sle()),
+				snapshot_dates=["2021-09-01", "2021-10-01", "2021-11-01"],
+			)
+			fifo_slots.generate()
+
+		self.assertEqual(len(fifo_slots.snapshots), 3)
+
+	def get_multi_item_sle(self):
+		"Receipts, issues and transfers of 6 items across 3 warehouses, in posting order."
+		balances = {}
+		sle = []
+
+		def add_entry(item_code, warehouse, qty, posting_date, voucher_no):
+			balances[(item_code, warehouse)] = balances.get((item_code, warehouse), 0) + qty
+			sle.append(
+				SLERow(
+					item_code,
+					0,
+					qty,
+					posting_date,
+					"Stock Entry",
+					voucher_no,
+					None,
+					None,
+					balances[(item_code, warehouse)],
+					warehouse,
+				)
+			)
+
+		for day in range(120):
+			posting_date = date(2021, 8, 1) + timedelta(days=day)
+			for i in range(6):
+				item_code = f"Flask Item {i}"
+				warehouse = f"WH {(day + i) % 3 + 1}"
+				if (day + i) % 4 == 3:
+					# transfer to the next warehouse
+					target = f"WH {(day + i + 1) % 3 + 1}"
+					add_entry(item_code, warehouse, -3, posting_date, f"SE-{day}-{i}")
+					add_entry(item_code, target, 3, posting_date, f"SE-{day}-{i}")
+				elif (day + i) % 3 == 2:
+					add_entry(item_code, warehouse, -4, posting_date, f"SE-{day}-{i}")
+				else:
+					add_entry(item_code, warehouse, 5 + i, posting_date, f"SE-{day}-{i}")
+
+		return sle
+
+	def test_parallel_replay_matches_serial_replay(self):
+		"Item partitions replayed apart and merged give the slots of a single replay."
+		sle = self.get_multi_item_sle()
+
+		class InProcessFIFOSlots(ParallelFIFOSlots):
+			def get_item_count(self):
+				return PARALLEL_REPLAY_MIN_ITEMS
+
+			def replay_partitions(self, filters):
+				# same split as the `mod(crc32(item_code), partitions)` ledger condition
+				for partition in range(self.workers):
+					yield FIFOSlots(
+						filters,
+						[row for row in sle if zlib.crc32(row.name.encode()) % self.workers == partition],
+					).generate()
+
+		for show_warehouse_wise_stock in (True, False):
+			self.filters.show_warehouse_wise_stock = show_warehouse_wise_stock
+			parallel = InProcessFIFOSlots(self.filters)
+			parallel.workers = 3
+
+			serial = FIFOSlots(self.filters, iter(sle)).generate()
+			self.assertEqual(
+				self.get_ageing_buckets(parallel.generate()), self.get_ageing_buckets(serial)
+			)
+
+	def test_transfer_buckets_are_evicted(self):
+		fifo_slots = FIFOSlots(self.filters, self.get_synthetic_sle(20000))
+		fifo_slots.generate()
+
+		# only the outward rows of the day being replayed are held
+		self.assertLessEqual(fifo_slots.peak_transfer_buckets, 50)
+		self.assertEqual(fifo_slots.evicted_transfer_buckets, 10000 - 50)
+		self.assertEqual(len(fifo_slots.transferred_item_details), 50)
+
+	def test_key_details_hold_no_ledger_row(self):
+		"Item attributes are joined at output time, keys only keep item code and warehouse."
+		item_details = FIFOSlots(self.filters, self.get_synthetic_sle(200)).generate()
+
+		for (item_code, warehouse), item_dict in item_details.items():
+			self.assertEqual(item_dict["details"], {"name": item_code, "warehouse": warehouse})
+
+	def test_configurable_ageing_ranges(self):
+		self.filters.ageing_ranges = "365, 15,30, 60,90,180"
+		boundaries = get_ageing_boundaries(self.filters)
+		self.assertEqual(boundaries, [15, 30, 60, 90, 180, 365])
+
+		range_columns = []
+		setup_ageing_columns(self.filters, range_columns)
+		self.assertEqual(
+			[column["label"] for column in range_columns][:2] + [range_columns[-1]["label"]],
+			["Age (0 - 15)", "Age (16 - 30)", "Age (366 - Above)"],
+		)
+
+		item_details = FIFOSlots(
+			self.filters,
+			self.get_sle(
+				[
+					(10, 10, "2020-11-01", "Stock Entry", "001"),
+					(5, 15, "2021-08-01", "Stock Entry", "002"),
+					(4, 19, "2021-11-20", "Stock Entry", "003"),
+					(2, 21, "2021-12-01", "Stock Entry", "004"),
+				]
+			),
+		).generate()
+		item_dict = item_details[("Flask Item", "WH 1")]
+
+		ageing_data = get_ageing_data(item_dict["fifo_queue"], self.filters.to_date, boundaries, 3)
+		self.assertEqual(ageing_data.range_qty, [2.0, 4.0, 0.0, 0.0, 5.0, 0.0, 10.0])
+
+	def test_brand_rollup(self):
+		self.filters.group_by = "Brand"
+		rollup = AgeingRollup(self.filters)
+
+		def add(item_code, brand, qty, average_age, range_qty, earliest, latest):
+			row = [item_code, item_code, None, "Products", brand, "WH 1", qty, 0.0, 10.0, qty * 10]
+			row.append(average_age)
+			for range_value in range_qty:
+				row.extend([range_value, range_value * 10])
+			row.extend([earliest, latest, "Nos"])
+			rollup.add(frappe._dict(item_group="Products", brand=brand), row)
+
+		add("Item A", "Brand X", 10, 20, [10, 0, 0, 0], 25, 5)
+		add("Item B", "Brand X", 30, 100, [0, 0, 10, 20], 150, 70)
+		add("Item C", None, 5, 40, [0, 5, 0, 0], 40, 40)
+
+		data = rollup.get_data()
+		self.assertEqual([(row.item_code, row.indent) for row in data], [
+			("Brand X", 0), ("Item A", 1), ("Item B", 1), ("No Brand", 0), ("Item C", 1),
+		])
+
+		brand_row = data[0]
+		self.assertEqual(brand_row.qty, 40)
+		self.assertEqual(brand_row.bal_val, 400)
+		self.assertEqual(brand_row.average_age, 80)
+		self.assertEqual([brand_row[f"range{i}"] for i in range(1, 5)], [10, 0, 10, 20])
+		self.assertEqual(brand_row.bal_val_above_range3, 200)
+		self.assertEqual((brand_row.earliest, brand_row.latest), (150, 5))
+
+	def test_item_group_rollup(self):
+		"Items add into their group and each parent group, rows are indented in tree order."
+		self.filters.group_by = "Item Group"
+		ancestors = {
+			"All Item Groups": (0, ["All Item Groups"]),
+			"Products": (1, ["All Item Groups", "Products"]),
+			"Sub Assemblies": (2, ["All Item Groups", "Products", "Sub Assemblies"]),
+			"Consumable": (1, ["All Item Groups", "Consumable"]),
+		}
+		with patch(
+			"custom_stock_ageing_report.custom_stock_ageing_report.report.custom_stock_ageing.custom_stock_ageing.get_item_group_ancestors",
+			return_value=ancestors,
+		):
+			rollup = AgeingRollup(self.filters)
+
+		def add(item_code, item_group, qty, average_age, range_qty, earliest, latest):
+			row = [item_code, item_code, None, item_group, None, "WH 1", qty, 0.0, 10.0, qty * 10]
+			row.append(average_age)
+			for range_value in range_qty:
+				row.extend([range_value, range_value * 10])
+			row.extend([earliest, latest, "Nos"])
+			rollup.add(frappe._dict(item_group=item_group, brand=None), row)
+
+		add("Item A", "Sub Assemblies", 10, 20, [10, 0, 0, 0], 25, 5)
+		add("Item B", "Products", 30, 100, [0, 0, 10, 20], 150, 70)
+		add("Item C", "Consumable", 5, 40, [0, 5, 0, 0], 40, 40)
+		add("Item D", "Deleted Group", 5, 10, [5, 0, 0, 0], 10, 10)
+
+		data = rollup.get_data()
+		self.assertEqual(
+			[(row.item_code, row.indent, row.parent_group) for row in data],
+			[
+				("All Item Groups", 0, None),
+				("Products", 1, "All Item Groups"),
+				("Item B", 2, "Products"),
+				("Sub Assemblies", 2, "Products"),
+				("Item A", 3, "Sub Assemblies"),
+				("Consumable", 1, "All Item Groups"),
+				("Item C", 2, "Consumable"),
+				("Deleted Group", 0, None),
+				("Item D", 1, "Deleted Group"),
+			],
+		)
+
+		totals = {row.item_code: row for row in data if row.get("is_group")}
+		self.assertEqual(
+			[totals[group].qty for group in ("All Item Groups", "Products", "Sub Assemblies")], [45, 40, 10]
+		)
+		self.assertEqual(totals["Products"].average_age, 80)
+		self.assertEqual([totals["All Item Groups"][f"range{i}"] for i in range(1, 5)], [10, 5, 10, 20])
+		self.assertEqual((totals["All Item Groups"].earliest, totals["All Item Groups"].latest), (150, 5))
+
+	def test_fixed_point_replay_fractional_qty(self):
+		"Fractional qty at the float precision is replayed exactly, slots add up to the ledger balance."
+		item_details = FIFOSlots(
+			self.filters,
+			self.get_sle(
+				[
+					(0.125, 0.125, "2021-10-01", "Stock Entry", "001"),
+					(0.333, 0.458, "2021-10-02", "Stock Entry", "002"),
+					(-0.2, 0.258, "2021-10-03", "Stock Entry", "003"),
+					(2.5, 2.758, "2021-10-04", "Stock Entry", "004"),
+					(-0.007, 2.751, "2021-10-05", "Stock Entry", "005"),
+				]
+			),
+		).generate()
+
+		item_dict = item_details[("Flask Item", "WH 1")]
+		self.assertEqual(list(item_dict["fifo_queue"]), [[0.251, "2021-10-02"], [2.5, "2021-10-04"]])
+		self.assertEqual(sum(slot[0] for slot in item_dict["fifo_queue"]), 2.751)
+		self.assertEqual(item_dict["total_qty"], 2.751)
+		self.assertEqual(item_dict["qty_after_transaction"], 2.751)
+
+	def test_fixed_point_replay_leaves_no_residual_slots(self):
+		item_details = FIFOSlots(
+			self.filters,
+			self.get_sle(
+				[
+					(0.1, 0.1, "2021-10-01", "Stock Entry", "001"),
+					(0.2, 0.3, "2021-10-02", "Stock Entry", "002"),
+					(-0.3, 0.0, "2021-10-03", "Stock Entry", "003"),
+					(1.1, 1.1, "2021-10-04", "Stock Entry", "004"),
+				]
+			),
+		).generate()
+
+		item_dict = item_details[("Flask Item", "WH 1")]
+		self.assertEqual(list(item_dict["fifo_queue"]), [[1.1, "2021-10-04"]])
+		self.assertEqual(item_dict["total_qty"], 1.1)
+		self.assertEqual(item_dict["qty_after_transaction"], 1.1)
+
+	def test_chart_top_n_keeps_row_order(self):
+		self.filters.update({"show_warehouse_wise_stock": 0, "chart_top_n": 2})
+
+		def get_row(item_code, bal_val, average_age, above_range_value):
+			row = [item_code, item_code, None, "Products", None, 10, 0.0, 1.0, bal_val, average_age]
+			return row + [0, 0] * 3 + [10, above_range_value] + [average_age, 0, "Nos"]
+
+		data = [
+			get_row("Item A", 500, 40, 0),
+			get_row("Item B", 100, 120, 100),
+			get_row("Item C", 900, 10, 0),
+			get_row("Item D", 300, 95, 300),
+		]
+		rows = [list(row) for row in data]
+
+		chart = get_chart_data(data, self.filters)
+		self.assertEqual(chart["data"]["labels"], ["Item B", "Item D"])
+		self.assertEqual(data, rows)
+
+		self.filters.chart_metric = "Value Above Last Range"
+		chart = get_chart_data(data, self.filters)
+		self.assertEqual(chart["data"]["labels"], ["Item D", "Item B"])
+		self.assertEqual(chart["data"]["datasets"][0]["values"], [300, 100])
+
+		self.filters.chart_metric = "Balance Value"
+		self.assertEqual(get_chart_data(data, self.filters)["data"]["labels"], ["Item C", "Item A"])
+
+	def test_warehouse_wise_chart_is_item_wise(self):
+		"Warehouse rows of the report are charted per item, same as an item wise run."
+		context = frappe._dict(precision=3, item_map={}, price_list_rates={}, valuation_rates={})
+		item_wise_filters = frappe._dict(self.filters, show_warehouse_wise_stock=0)
+
+		with patch(
+			"custom_stock_ageing_report.custom_stock_ageing_report.report.custom_stock_ageing.custom_stock_ageing.get_report_context",
+			return_value=context,
+		):
+			item_details = FIFOSlots(self.filters, self.get_multi_item_sle()).generate()
+			chart = get_item_wise_chart_data(self.filters, item_details)
+
+			item_wise_details = FIFOSlots(item_wise_filters, self.get_multi_item_sle()).generate()
+			expected = get_chart_data(
+				format_report_data(item_wise_filters, item_wise_details, self.filters.to_date),
+				item_wise_filters,
+			)
+
+		self.assertTrue(chart["data"]["labels"])
+		self.assertEqual(chart, expected)
+		self.assertTrue(self.filters.show_warehouse_wise_stock)
+
+	def test_batch_balances_match_replay(self):
+		"Batches consumed oldest first age the same from batch balances as by the replay."
+		from erpnext.stock.doctype.item.test_item import make_item
+		from erpnext.stock.doctype.stock_entry.stock_entry_utils import make_stock_entry
+
+		self.addCleanup(frappe.db.rollback)
+		item_code = make_item("_Test Ageing Batch Item", {"is_stock_item": 1, "has_batch_no": 1}).name
+		batches = []
+		for batch_id in ("_TAB-001", "_TAB-002", "_TAB-003"):
+			if not frappe.db.exists("Batch", batch_id):
+				frappe.get_doc({"doctype": "Batch", "batch_id": batch_id, "item": item_code}).insert()
+			batches.append(batch_id)
+
+		warehouse, target = "_Test Warehouse - _TC", "_Test Warehouse 1 - _TC"
+		for posting_date, qty, batch_no, source, to in (
+			("2021-08-01", 10, batches[0], None, warehouse),
+			("2021-09-01", 10, batches[1], None, warehouse),
+			("2021-09-15", 6, batches[0], warehouse, None),
+			# transferred stock is aged from its arrival in the target warehouse
+			("2021-10-01", 4, batches[0], warehouse, target),
+			("2021-11-01", 5, batches[2], None, warehouse),
+			("2021-11-15", 3, batches[1], warehouse, None),
+		):
+			make_stock_entry(
+				item_code=item_code,
+				source=source,
+				target=to,
+				qty=qty,
+				rate=100,
+				batch_no=batch_no,
+				posting_date=posting_date,
+			)
+
+		self.filters.item_code = item_code
+		batch_wise = FIFOSlots(self.filters).generate()
+		replay = FIFOSlots(frappe._dict(self.filters, replay_batch_items=1)).generate()
+
+		self.assertEqual(self.get_ageing_buckets(batch_wise), self.get_ageing_buckets(replay))
+		self.assertEqual(
+			list(batch_wise[(item_code, target)]["fifo_queue"]), [[4.0, getdate("2021-10-01")]]
+		)
+
+	def test_reverse_fifo_ledger_query_matches_entries(self):
+		"Inward entries fetched by the ledger query give the slots of walking every entry."
+		from erpnext.stock.doctype.item.test_item import make_item
+		from erpnext.stock.doctype.stock_entry.stock_entry_utils import make_stock_entry
+		from erpnext.stock.doctype.stock_reconciliation.test_stock_reconciliation import (
+			create_stock_reconciliation,
+		)
+
+		self.addCleanup(frappe.db.rollback)
+		item_code = make_item("_Test Reverse FIFO Item", {"is_stock_item": 1}).name
+		warehouse, target = "_Test Warehouse - _TC", "_Test Warehouse 1 - _TC"
+
+		for posting_date, qty, source, to in (
+			("2021-08-01", 30, None, warehouse),
+			("2021-09-15", 20, None, warehouse),
+			("2021-10-01", 35, warehouse, None),
+			("2021-10-20", 5, warehouse, target),
+		):
+			make_stock_entry(
+				item_code=item_code, source=source, target=to, qty=qty, rate=100, posting_date=posting_date
+			)
+
+		create_stock_reconciliation(
+			item_code=item_code, warehouse=warehouse, qty=12, rate=100, posting_date="2021-11-10"
+		)
+		make_stock_entry(item_code=item_code, target=warehouse, qty=8, rate=100, posting_date="2021-11-20")
+
+		sle = self.get_ledger_entries(item_code)
+
+		self.filters.item_code = item_code
+		ledger_query = ReverseFIFOSlots(self.filters).generate()
+		entries = ReverseFIFOSlots(self.filters, sle).generate()
+
+		self.assertEqual(self.get_ageing_buckets(ledger_query), self.get_ageing_buckets(entries))
+		self.assertEqual(ledger_query[(item_code, warehouse)]["total_qty"], 20.0)
+
+	def test_price_list_rate_valid_on_to_date(self):
+		from erpnext.stock.doctype.item.test_item import make_item
+
+		self.addCleanup(frappe.db.rollback)
+		price_list = "_Test Ageing Price List"
+		if not frappe.db.exists("Price List", price_list):
+			frappe.get_doc(
+				{"doctype": "Price List", "price_list_name": price_list, "selling": 1, "currency": "INR"}
+			).insert()
+
+		item_codes = []
+		for item_code in ("_Test Ageing Price Item A", "_Test Ageing Price Item B", "_Test Ageing Price Item C"):
+			item_codes.append(make_item(item_code, {"is_stock_item": 1}).name)
+
+		def add_price(item_code, rate, valid_from=None, valid_upto=None):
+			item_price = frappe.get_doc(
+				{
+					"doctype": "Item Price",
+					"price_list": price_list,
+					"item_code": item_code,
+					"price_list_rate": rate,
+					"valid_from": valid_from,
+					"valid_upto": valid_upto,
+				}
+			).insert()
+			if not valid_from:
+				# valid from defaults to today
+				frappe.db.set_value("Item Price", item_price.name, "valid_from", None)
+
+		add_price(item_codes[0], 10)
+		add_price(item_codes[0], 20, "2021-01-01")
+		add_price(item_codes[0], 30, "2021-11-01", "2021-11-30")  # expired
+		add_price(item_codes[0], 40, "2022-01-01")  # not valid yet
+		add_price(item_codes[1], 15)
+		add_price(item_codes[2], 25, None, "2021-06-30")  # expired
+
+		self.assertEqual(
+			get_price_list_rates(price_list, item_codes, self.filters.to_date),
+			{item_codes[0]: 20.0, item_codes[1]: 15.0},
+		)
@@ -89,6 +89,21 @@ frappe.query_reports["Custom Stock Balance with Price_List"] = {
 			"label": __('Show Stock Ageing Data'),
 			"fieldtype": 'Check'
 		},
+		{
+			"fieldname": "ageing_page_length",
+			"label": __("Ageing Page Length"),
+			"fieldtype": "Int",
+			"depends_on": "eval: doc.show_stock_ageing_data",
+			"description": __("Compute stock ageing for this many rows only, by Item and Warehouse. Leave 0 for all rows.")
+		},
+		{
+			"fieldname": "ageing_page_start",
+			"label": __("Ageing Page Start"),
+			"fieldtype": "Int",
+			"default": 0,
+			"depends_on": "eval: doc.show_stock_ageing_data && doc.ageing_page_length",
+			"description": __("Rows to skip before the ageing page, 0 for the first row")
+		},
 		{
 			"fieldname": 'ignore_closing_balance',
 			"label": __('Ignore Closing Balance'),
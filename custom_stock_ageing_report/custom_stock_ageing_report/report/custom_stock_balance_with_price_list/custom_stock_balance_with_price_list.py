@@ -2,22 +2,35 @@
 # License: GNU General Public License v3. See license.txt
 
 
+import json
+from array import array
 from operator import itemgetter
 from typing import Any, Dict, List, Optional, TypedDict
 
 import frappe
 from frappe import _
 from frappe.query_builder import Order
-from frappe.query_builder.functions import Coalesce, CombineDatetime
-from frappe.utils import add_days, cint, date_diff, flt, getdate
+from frappe.query_builder.functions import CombineDatetime, IfNull
+from frappe.utils import add_days, cint, date_diff, flt, getdate, now
 from frappe.utils.nestedset import get_descendants_of
 
 import erpnext
 from erpnext.stock.doctype.inventory_dimension.inventory_dimension import get_inventory_dimensions
 from erpnext.stock.doctype.warehouse.warehouse import apply_warehouse_filter
-from erpnext.stock.report.stock_ageing.stock_ageing import FIFOSlots, get_average_age
 from erpnext.stock.utils import add_additional_uom_columns
 
+from custom_stock_ageing_report.custom_stock_ageing_report.doctype.closing_stock_balance_entry.closing_stock_balance_entry import (
+	is_closing_stock_balance_indexed,
+	queue_closing_stock_balance_index,
+)
+from custom_stock_ageing_report.custom_stock_ageing_report.doctype.stock_balance_report_row.stock_balance_report_row import (
+	SORT_FIELDS,
+)
+from custom_stock_ageing_report.custom_stock_ageing_report.report.custom_stock_ageing.custom_stock_ageing import (
+	FIFOSlots,
+	get_average_age,
+)
+
 
 class StockBalanceFilter(TypedDict):
 	company: Optional[str]
@@ -34,6 +47,30 @@ class StockBalanceFilter(TypedDict):
 
 SLEntry = Dict[str, Any]
 
+PRICE_LIST_RATE_BATCH_SIZE = 10000
+# seconds cached price list rates are kept, Item Price changes invalidate them earlier
+PRICE_LIST_RATE_CACHE_EXPIRY = 24 * 60 * 60
+
+REPORT_NAME = "Custom Stock Balance with Price_List"
+
+# fields of a report row stored as columns of Stock Balance Report Row, to sort and filter on
+REPORT_ROW_FIELDS = (
+	"item_code",
+	"item_name",
+	"item_group",
+	"warehouse",
+	"opening_qty",
+	"in_qty",
+	"out_qty",
+	"bal_qty",
+	"bal_val",
+	"val_rate",
+	"price_list_rate",
+	"average_age",
+)
+FILTER_OPERATORS = ("=", "!=", ">", "<", ">=", "<=", "like")
+MAX_PAGE_LENGTH = 500
+
 
 def execute(filters: Optional[StockBalanceFilter] = None):
 	return StockBalanceReport(filters).run()
@@ -62,7 +99,6 @@ class StockBalanceReport(object):
 
 		self.inventory_dimensions = self.get_inventory_dimension_fields()
 		self.prepare_opening_data_from_closing_balance()
-		self.prepare_stock_ledger_entries()
 		self.prepare_new_data()
 
 		if not self.columns:
@@ -80,26 +116,13 @@ class StockBalanceReport(object):
 			return
 
 		self.start_from = add_days(closing_balance[0].to_date, 1)
-		res = frappe.get_doc("Closing Stock Balance", closing_balance[0].name).get_prepared_data()
-
-		for entry in res.data:
-			entry = frappe._dict(entry)
 
+		for entry in self.get_closing_balance_entries(closing_balance[0].name):
 			group_by_key = self.get_group_by_key(entry)
 			if group_by_key not in self.opening_data:
 				self.opening_data.setdefault(group_by_key, entry)
 
 	def prepare_new_data(self):
-		if not self.sle_entries:
-			return
-		
-
-		if self.filters.get("show_stock_ageing_data"):
-			self.filters["show_warehouse_wise_stock"] = True
-			item_wise_fifo_queue = FIFOSlots(self.filters, self.sle_entries).generate()
-
-		_func = itemgetter(1)
-
 		self.item_warehouse_map = self.get_item_warehouse_map()
 		price_list_rate_map = self.get_price_list_rates()
 
@@ -107,31 +130,20 @@ class StockBalanceReport(object):
 		if self.filters.get("show_variant_attributes"):
 			variant_values = self.get_variant_values_for()
 
+		# ageing is only computed for the keys left after filtering
+		ageing_keys, item_wise_fifo_queue = set(), {}
+		if self.filters.get("show_stock_ageing_data"):
+			ageing_keys = self.get_ageing_keys()
+			item_wise_fifo_queue = self.get_item_wise_fifo_queue(ageing_keys)
+
 		for key, report_data in self.item_warehouse_map.items():
 			if variant_data := variant_values.get(report_data.item_code):
 				report_data.update(variant_data)
 
-			if self.filters.get("show_stock_ageing_data"):
-				opening_fifo_queue = self.get_opening_fifo_queue(report_data) or []
-
-				fifo_queue = []
-				if fifo_queue := item_wise_fifo_queue.get((report_data.item_code, report_data.warehouse)):
-					fifo_queue = fifo_queue.get("fifo_queue")
-
-				if fifo_queue:
-					opening_fifo_queue.extend(fifo_queue)
-
-				stock_ageing_data = {"average_age": 0, "earliest_age": 0, "latest_age": 0}
-				if opening_fifo_queue:
-					fifo_queue = sorted(filter(_func, opening_fifo_queue), key=_func)
-					if not fifo_queue:
-						continue
-
-					to_date = self.to_date
-					stock_ageing_data["average_age"] = get_average_age(fifo_queue, to_date)
-					stock_ageing_data["earliest_age"] = date_diff(to_date, fifo_queue[0][1])
-					stock_ageing_data["latest_age"] = date_diff(to_date, fifo_queue[-1][1])
-					stock_ageing_data["fifo_queue"] = fifo_queue
+			if key in ageing_keys:
+				stock_ageing_data = self.get_stock_ageing_data(report_data, item_wise_fifo_queue)
+				if stock_ageing_data is None:
+					continue
 
 				report_data.update(stock_ageing_data)
 
@@ -140,103 +152,164 @@ class StockBalanceReport(object):
 			self.data.append(report_data)
 
 	
+	def get_ageing_keys(self):
+		"""
+		Keys to compute ageing for, all of them unless `ageing_page_length` is set,
+		then only those of the page starting at `ageing_page_start` (0 based) in the order
+		rows are shown in, by item code and warehouse.
+		"""
+		keys = list(self.item_warehouse_map)
+		if page_length := cint(self.filters.get("ageing_page_length")):
+			start = cint(self.filters.get("ageing_page_start"))
+			keys = keys[start : start + page_length]
+
+		return set(keys)
+
+	def get_item_wise_fifo_queue(self, keys):
+		"""
+		Replay FIFO for the (item, warehouse) pairs of `keys` only. Transfer buckets are
+		kept per (voucher, item, warehouse), stock transferred in is aged from its arrival,
+		so a pair replays the same without the entries of other warehouses.
+		"""
+		if not keys:
+			return {}
+
+		pairs = {(key[1], key[2]) for key in keys}
+		self.prepare_stock_ledger_entries(
+			item_codes={item_code for item_code, _warehouse in pairs},
+			warehouses={warehouse for _item_code, warehouse in pairs},
+		)
+		self.sle_entries = [
+			entry for entry in self.sle_entries if (entry.item_code, entry.warehouse) in pairs
+		]
+		self.filters["show_warehouse_wise_stock"] = True
+
+		return FIFOSlots(self.filters, self.sle_entries).generate()
+
+	def get_stock_ageing_data(self, report_data, item_wise_fifo_queue):
+		"Returns None when the queue only has consumed slots, such rows are left out of the report."
+		_func = itemgetter(1)
+		opening_fifo_queue = self.get_opening_fifo_queue(report_data) or []
+
+		fifo_queue = []
+		if fifo_queue := item_wise_fifo_queue.get((report_data.item_code, report_data.warehouse)):
+			fifo_queue = fifo_queue.get("fifo_queue")
+
+		if fifo_queue:
+			opening_fifo_queue.extend(fifo_queue)
+
+		stock_ageing_data = {"average_age": 0, "earliest_age": 0, "latest_age": 0}
+		if opening_fifo_queue:
+			fifo_queue = sorted(filter(_func, opening_fifo_queue), key=_func)
+			if not fifo_queue:
+				return None
+
+			to_date = self.to_date
+			stock_ageing_data["average_age"] = get_average_age(fifo_queue, to_date)
+			stock_ageing_data["earliest_age"] = date_diff(to_date, fifo_queue[0][1])
+			stock_ageing_data["latest_age"] = date_diff(to_date, fifo_queue[-1][1])
+			stock_ageing_data["fifo_queue"] = [list(slot) for slot in fifo_queue]
+
+		return stock_ageing_data
+
 	def get_price_list_rates(self):
-		price_list_rate_map = {}	
+		"""
+		Returns price list rates of the items in the report.
+
+		Rates are cached per price list and filled in as items are reported on, only
+		items not cached yet are queried. Items without a rate are cached as 0.
+
+		The cached rates are tagged with the generation of the price list read before
+		querying, a rate changed meanwhile starts a new generation and they are not used.
+		"""
 		price_list = self.filters.get("price_list")
 		if not price_list:
-			return price_list_rate_map
-		
-		table = frappe.qb.DocType("Item Price")
-		query = (
-        frappe.qb.from_(table)
-        .select(table.item_code, table.price_list_rate)
-        .where((table.price_list == price_list) & (table.price_list_rate > 0))
-    	)
-		
-		result = query.run(as_dict=True)
-		for d in result:
-			price_list_rate_map[d.item_code] = d.price_list_rate
-		
-		return price_list_rate_map
-		
-	def get_item_warehouse_map(self):
-		item_warehouse_map = {}
-		self.opening_vouchers = self.get_opening_vouchers()
-
-		for entry in self.sle_entries:
-			group_by_key = self.get_group_by_key(entry)
-			if group_by_key not in item_warehouse_map:
-				self.initialize_data(item_warehouse_map, group_by_key, entry)
+			return {}
 
-			self.prepare_item_warehouse_map(item_warehouse_map, entry, group_by_key)
+		item_codes = set(self.item_warehouse_map.details["item_code"])
+		cache = frappe.cache()
+		generation = get_price_list_rate_generation(price_list)
+		cache_key = get_price_list_rate_cache_key(price_list)
 
-			if self.opening_data.get(group_by_key):
-				del self.opening_data[group_by_key]
+		cached = cache.get_value(cache_key) or {}
+		price_list_rate_map = cached.get("rates", {}) if cached.get("generation") == generation else {}
 
-		for group_by_key, entry in self.opening_data.items():
-			if group_by_key not in item_warehouse_map:
-				self.initialize_data(item_warehouse_map, group_by_key, entry)
+		if missing_item_codes := list(item_codes.difference(price_list_rate_map)):
+			price_list_rate_map.update(dict.fromkeys(missing_item_codes, 0.0))
 
-		item_warehouse_map = filter_items_with_no_transactions(
-			item_warehouse_map, self.float_precision, self.inventory_dimensions
-		)
+			table = frappe.qb.DocType("Item Price")
+			for start in range(0, len(missing_item_codes), PRICE_LIST_RATE_BATCH_SIZE):
+				query = (
+					frappe.qb.from_(table)
+					.select(table.item_code, table.price_list_rate)
+					.where(
+						(table.price_list == price_list)
+						& (table.price_list_rate > 0)
+						& (table.item_code.isin(missing_item_codes[start : start + PRICE_LIST_RATE_BATCH_SIZE]))
+					)
+				)
 
-		return item_warehouse_map
+				for d in query.run(as_dict=True):
+					price_list_rate_map[d.item_code] = d.price_list_rate
 
-	def prepare_item_warehouse_map(self, item_warehouse_map, entry, group_by_key):
-		qty_dict = item_warehouse_map[group_by_key]
-		for field in self.inventory_dimensions:
-			qty_dict[field] = entry.get(field)
+			if get_price_list_rate_generation(price_list) == generation:
+				cache.set_value(
+					cache_key,
+					{"generation": generation, "rates": price_list_rate_map},
+					expires_in_sec=PRICE_LIST_RATE_CACHE_EXPIRY,
+				)
 
-		if entry.voucher_type == "Stock Reconciliation" and (not entry.batch_no or entry.serial_no):
-			qty_diff = flt(entry.qty_after_transaction) - flt(qty_dict.bal_qty)
-		else:
-			qty_diff = flt(entry.actual_qty)
+		return {item_code: price_list_rate_map[item_code] for item_code in item_codes}
 
-		value_diff = flt(entry.stock_value_difference)
+	def get_item_warehouse_map(self) -> "ItemWarehouseMap":
+		item_warehouse_map = ItemWarehouseMap(
+			self.inventory_dimensions, self.company_currency, self.float_precision
+		)
 
-		if entry.posting_date < self.from_date or entry.voucher_no in self.opening_vouchers.get(
-			entry.voucher_type, []
-		):
-			qty_dict.opening_qty += qty_diff
-			qty_dict.opening_val += value_diff
+		for entry in self.get_aggregated_stock_ledger_entries():
+			group_by_key = self.get_group_by_key(entry)
+			opening_data = self.opening_data.pop(group_by_key, None) or {}
 
-		elif entry.posting_date >= self.from_date and entry.posting_date <= self.to_date:
+			key_id = self.initialize_data(item_warehouse_map, group_by_key, entry, opening_data)
+			self.prepare_item_warehouse_map(item_warehouse_map, entry, key_id)
 
-			if flt(qty_diff, self.float_precision) >= 0:
-				qty_dict.in_qty += qty_diff
-				qty_dict.in_val += value_diff
-			else:
-				qty_dict.out_qty += abs(qty_diff)
-				qty_dict.out_val += abs(value_diff)
+		for group_by_key, entry in self.opening_data.items():
+			self.initialize_data(item_warehouse_map, group_by_key, entry, entry)
 
-		qty_dict.val_rate = entry.valuation_rate
-		qty_dict.bal_qty += qty_diff
-		qty_dict.bal_val += value_diff
+		item_warehouse_map = filter_items_with_no_transactions(
+			item_warehouse_map, self.float_precision, self.inventory_dimensions
+		)
 
-	def initialize_data(self, item_warehouse_map, group_by_key, entry):
-		opening_data = self.opening_data.get(group_by_key, {})
+		# rows are shown by item and warehouse, ageing pages follow the same order
+		return item_warehouse_map.sort()
 
-		item_warehouse_map[group_by_key] = frappe._dict(
+	def prepare_item_warehouse_map(self, item_warehouse_map, entry, key_id: int):
+		"Add the totals of a group by key (see `get_aggregated_stock_ledger_entries`) to its opening."
+		for field in self.inventory_dimensions:
+			item_warehouse_map.details[field][key_id] = entry.get(field)
+
+		columns = item_warehouse_map.columns
+		for field in ("opening_qty", "opening_val", "in_qty", "in_val", "out_qty", "out_val", "bal_qty", "bal_val"):
+			columns[field][key_id] += flt(entry[field])
+
+		columns["val_rate"][key_id] = flt(entry.val_rate)
+
+	def initialize_data(self, item_warehouse_map, group_by_key, entry, opening_data) -> int:
+		return item_warehouse_map.add(
+			group_by_key,
 			{
 				"item_code": entry.item_code,
 				"warehouse": entry.warehouse,
 				"item_group": entry.item_group,
 				"company": entry.company,
-				"currency": self.company_currency,
 				"stock_uom": entry.stock_uom,
 				"item_name": entry.item_name,
-				"opening_qty": opening_data.get("bal_qty") or 0.0,
-				"opening_val": opening_data.get("bal_val") or 0.0,
 				"opening_fifo_queue": opening_data.get("fifo_queue") or [],
-				"in_qty": 0.0,
-				"in_val": 0.0,
-				"out_qty": 0.0,
-				"out_val": 0.0,
-				"bal_qty": opening_data.get("bal_qty") or 0.0,
-				"bal_val": opening_data.get("bal_val") or 0.0,
-				"val_rate": 0.0,
-			}
+				"opening_qty": flt(opening_data.get("bal_qty")),
+				"opening_val": flt(opening_data.get("bal_val")),
+				"bal_qty": flt(opening_data.get("bal_qty")),
+				"bal_val": flt(opening_data.get("bal_val")),
+			},
 		)
 
 	def get_group_by_key(self, row) -> tuple:
@@ -259,6 +332,7 @@ class StockBalanceReport(object):
 			.select(table.name, table.to_date)
 			.where(
 				(table.docstatus == 1)
+				& (table.status == "Completed")
 				& (table.company == self.filters.company)
 				& ((table.to_date <= self.from_date))
 			)
@@ -266,13 +340,273 @@ class StockBalanceReport(object):
 			.limit(1)
 		)
 
+		# company wide (monthly) closings hold every key, those outside the filters are skipped
 		for fieldname in ["warehouse", "item_code", "item_group", "warehouse_type"]:
 			if self.filters.get(fieldname):
-				query = query.where(table[fieldname] == self.filters.get(fieldname))
+				query = query.where(
+					(table[fieldname] == self.filters.get(fieldname)) | (IfNull(table[fieldname], "") == "")
+				)
+			else:
+				query = query.where(IfNull(table[fieldname], "") == "")
 
 		return query.run(as_dict=True)
 
-	def prepare_stock_ledger_entries(self):
+	def get_closing_balance_entries(self, closing_stock_balance: str) -> List[SLEntry]:
+		"""
+		Returns the entries of a closing balance within the report filters, read from
+		its index rather than from the whole prepared data. A closing not indexed yet is
+		queued for indexing and read from its prepared data this time.
+		"""
+		if not is_closing_stock_balance_indexed(closing_stock_balance):
+			queue_closing_stock_balance_index(closing_stock_balance)
+			return self.get_prepared_closing_balance_entries(closing_stock_balance)
+
+		entry_table = frappe.qb.DocType("Closing Stock Balance Entry")
+		item_table = frappe.qb.DocType("Item")
+		query = (
+			frappe.qb.from_(entry_table)
+			.inner_join(item_table)
+			.on(entry_table.item_code == item_table.name)
+			.select(
+				entry_table.company,
+				entry_table.item_code,
+				entry_table.warehouse,
+				entry_table.item_group,
+				item_table.item_name,
+				item_table.stock_uom,
+				entry_table.bal_qty,
+				entry_table.bal_val,
+				entry_table.fifo_queue,
+				entry_table.inventory_dimensions,
+			)
+			.where(entry_table.closing_stock_balance == closing_stock_balance)
+		)
+
+		query = self.apply_warehouse_filters(query, entry_table)
+		query = self.apply_items_filters(query, item_table)
+
+		dimension_filters = {
+			fieldname: set(frappe.parse_json(self.filters.get(fieldname)))
+			for fieldname in self.inventory_dimensions
+			if self.filters.get(fieldname)
+		}
+
+		entries = []
+		for entry in query.run(as_dict=True):
+			entry.update(json.loads(entry.pop("inventory_dimensions") or "{}"))
+			if any(entry.get(fieldname) not in values for fieldname, values in dimension_filters.items()):
+				continue
+
+			entry.fifo_queue = json.loads(entry.fifo_queue or "[]")
+			entries.append(entry)
+
+		return entries
+
+	def get_prepared_closing_balance_entries(self, closing_stock_balance: str) -> List[SLEntry]:
+		"Returns the entries of a closing balance within the report filters from its prepared data."
+		res = frappe.get_doc("Closing Stock Balance", closing_stock_balance).get_prepared_data()
+		matches_filters = self.get_opening_data_filter()
+
+		entries = []
+		for entry in res.data:
+			entry = frappe._dict(entry)
+			if matches_filters(entry):
+				entries.append(entry)
+
+		return entries
+
+	def get_opening_data_filter(self):
+		"Returns a function telling if a closing balance entry is within the report filters."
+		checks = []
+
+		if warehouse := self.filters.get("warehouse"):
+			warehouses = set(get_descendants_of("Warehouse", warehouse, ignore_permissions=True))
+			warehouses.add(warehouse)
+			checks.append(lambda entry: entry.warehouse in warehouses)
+
+		if warehouse_type := self.filters.get("warehouse_type"):
+			warehouses_of_type = set(
+				frappe.get_all("Warehouse", filters={"warehouse_type": warehouse_type}, pluck="name")
+			)
+			checks.append(lambda entry: entry.warehouse in warehouses_of_type)
+
+		if item_code := self.filters.get("item_code"):
+			checks.append(lambda entry: entry.item_code == item_code)
+
+		if item_group := self.filters.get("item_group"):
+			item_groups = set(get_descendants_of("Item Group", item_group, ignore_permissions=True))
+			item_groups.add(item_group)
+			checks.append(lambda entry: entry.item_group in item_groups)
+
+		if brand := self.filters.get("brand"):
+			items_of_brand = set(frappe.get_all("Item", filters={"brand": brand}, pluck="name"))
+			checks.append(lambda entry: entry.item_code in items_of_brand)
+
+		for fieldname in self.inventory_dimensions:
+			if self.filters.get(fieldname):
+				values = set(frappe.parse_json(self.filters.get(fieldname)))
+				checks.append(lambda entry, fieldname=fieldname, values=values: entry.get(fieldname) in values)
+
+		return lambda entry: all(check(entry) for check in checks)
+
+	def get_aggregated_stock_ledger_entries(self) -> List[SLEntry]:
+		"""
+		Returns opening, in and out qty and value, balance and the last valuation rate
+		per group by key, totalled in the database so only one row per key is fetched.
+
+		Entries before the from date or of opening vouchers count towards the opening.
+		Stock Reconciliation (except for batches without serial nos) sets the balance,
+		its qty is the change from the previous balance of the (item, warehouse).
+		"""
+		conditions, values = self.get_sle_conditions()
+
+		group_by_fields = ["company", "item_code", "warehouse"] + [
+			fieldname for fieldname in self.inventory_dimensions if self.filters.get(fieldname)
+		]
+		# other dimensions are taken from the last entry
+		last_value_fields = ["valuation_rate"] + [
+			fieldname for fieldname in self.inventory_dimensions if fieldname not in group_by_fields
+		]
+
+		group_by = ", ".join(f"sle.`{fieldname}`" for fieldname in group_by_fields)
+		last_entry_order = "sle.posting_date desc, sle.posting_time desc, sle.creation desc, sle.actual_qty desc"
+		last_values = "".join(
+			f""",
+				first_value(sle.`{fieldname}`) over (
+					partition by {group_by} order by {last_entry_order}
+				) as `{fieldname}`"""
+			for fieldname in last_value_fields
+		)
+
+		previous_balance = "0"
+		if self.start_from and not self.filters.get("ignore_closing_balance"):
+			# balance carried in from the closing balance for the first entry scanned
+			previous_balance = """(
+				select prev.qty_after_transaction
+				from `tabStock Ledger Entry` prev
+				where
+					prev.item_code = sle.item_code
+					and prev.warehouse = sle.warehouse
+					and prev.is_cancelled = 0
+					and prev.posting_date < %(start_from)s
+				order by prev.posting_date desc, prev.posting_time desc, prev.creation desc
+				limit 1
+			)"""
+
+		values.update(
+			{
+				"from_date": self.from_date,
+				"precision": self.float_precision,
+			}
+		)
+
+		return frappe.db.sql(
+			f"""
+			select
+				{", ".join(f"entries.`{fieldname}`" for fieldname in group_by_fields)},
+				{"".join(f"max(entries.`{fieldname}`) as `{fieldname}`, " for fieldname in last_value_fields[1:])}
+				max(entries.item_group) as item_group,
+				max(entries.stock_uom) as stock_uom,
+				max(entries.item_name) as item_name,
+				sum(if(entries.is_opening, entries.qty_diff, 0)) as opening_qty,
+				sum(if(entries.is_opening, entries.stock_value_difference, 0)) as opening_val,
+				sum(if(not entries.is_opening and entries.is_inward, entries.qty_diff, 0)) as in_qty,
+				sum(if(not entries.is_opening and entries.is_inward, entries.stock_value_difference, 0))
+					as in_val,
+				sum(if(not entries.is_opening and not entries.is_inward, abs(entries.qty_diff), 0))
+					as out_qty,
+				sum(if(
+					not entries.is_opening and not entries.is_inward,
+					abs(entries.stock_value_difference),
+					0
+				)) as out_val,
+				sum(entries.qty_diff) as bal_qty,
+				sum(entries.stock_value_difference) as bal_val,
+				max(entries.valuation_rate) as val_rate
+			from (
+				select
+					sle_entries.*,
+					round(qty_diff, %(precision)s) >= 0 as is_inward
+				from (
+					select
+						{group_by}, item.item_group, item.stock_uom, item.item_name,
+						sle.stock_value_difference,
+						(
+							sle.posting_date < %(from_date)s
+							or (sle.voucher_type = 'Stock Entry' and sle.voucher_no in (
+								select se.name from `tabStock Entry` se
+								where se.is_opening = 'Yes' and se.docstatus = 1
+							))
+							or (sle.voucher_type = 'Stock Reconciliation' and sle.voucher_no in (
+								select sr.name from `tabStock Reconciliation` sr
+								where sr.purpose = 'Opening Stock' and sr.docstatus = 1
+							))
+						) as is_opening,
+						if(
+							sle.voucher_type = 'Stock Reconciliation'
+							and (ifnull(sle.batch_no, '') = '' or ifnull(sle.serial_no, '') != ''),
+							sle.qty_after_transaction - coalesce(lag(sle.qty_after_transaction) over (
+								partition by sle.item_code, sle.warehouse
+								order by sle.posting_date, sle.posting_time, sle.creation, sle.actual_qty
+							), {previous_balance}, 0),
+							sle.actual_qty
+						) as qty_diff{last_values}
+					from `tabStock Ledger Entry` sle
+					inner join `tabItem` item on item.name = sle.item_code
+					where {conditions}
+				) sle_entries
+			) entries
+			group by {", ".join(f"entries.`{fieldname}`" for fieldname in group_by_fields)}
+			""",
+			values,
+			as_dict=True,
+		)
+
+	def get_sle_conditions(self):
+		"Returns SQL conditions on `sle` and `item` for the report filters."
+		conditions = ["sle.docstatus < 2", "sle.is_cancelled = 0", "sle.posting_date <= %(to_date)s"]
+		values = {"to_date": self.to_date}
+
+		if self.filters.get("company"):
+			conditions.append("sle.company = %(company)s")
+			values["company"] = self.filters.get("company")
+
+		if not self.filters.get("ignore_closing_balance") and self.start_from:
+			conditions.append("sle.posting_date >= %(start_from)s")
+			values["start_from"] = self.start_from
+
+		for fieldname in self.inventory_dimensions:
+			if self.filters.get(fieldname):
+				conditions.append(f"sle.`{fieldname}` in %({fieldname})s")
+				values[fieldname] = tuple(frappe.parse_json(self.filters.get(fieldname)))
+
+		if warehouse := self.filters.get("warehouse"):
+			lft, rgt = frappe.db.get_value("Warehouse", warehouse, ["lft", "rgt"])
+			conditions.append(
+				"""sle.warehouse in (
+					select wh.name from `tabWarehouse` wh where wh.lft >= %(lft)s and wh.rgt <= %(rgt)s
+				)"""
+			)
+			values.update({"lft": lft, "rgt": rgt})
+		elif warehouse_type := self.filters.get("warehouse_type"):
+			conditions.append(
+				"sle.warehouse in (select wh.name from `tabWarehouse` wh where wh.warehouse_type = %(warehouse_type)s)"
+			)
+			values["warehouse_type"] = warehouse_type
+
+		if item_group := self.filters.get("item_group"):
+			children = get_descendants_of("Item Group", item_group, ignore_permissions=True)
+			conditions.append("item.item_group in %(item_groups)s")
+			values["item_groups"] = tuple(children + [item_group])
+
+		for field in ["item_code", "brand"]:
+			if self.filters.get(field):
+				conditions.append(f"item.{field} = %({field})s")
+				values[field] = self.filters.get(field)
+
+		return " and ".join(conditions), values
+
+	def prepare_stock_ledger_entries(self, item_codes=None, warehouses=None):
 		sle = frappe.qb.DocType("Stock Ledger Entry")
 		item_table = frappe.qb.DocType("Item")
 
@@ -313,6 +647,12 @@ class StockBalanceReport(object):
 		if self.filters.get("company"):
 			query = query.where(sle.company == self.filters.get("company"))
 
+		if item_codes:
+			query = query.where(sle.item_code.isin(list(item_codes)))
+
+		if warehouses:
+			query = query.where(sle.warehouse.isin(list(warehouses)))
+
 		self.sle_entries = query.run(as_dict=True)
 
 	def apply_inventory_dimensions_filters(self, query, sle) -> str:
@@ -547,35 +887,6 @@ class StockBalanceReport(object):
 
 		return attribute_map
 
-	def get_opening_vouchers(self):
-		opening_vouchers = {"Stock Entry": [], "Stock Reconciliation": []}
-
-		se = frappe.qb.DocType("Stock Entry")
-		sr = frappe.qb.DocType("Stock Reconciliation")
-
-		vouchers_data = (
-			frappe.qb.from_(
-				(
-					frappe.qb.from_(se)
-					.select(se.name, Coalesce("Stock Entry").as_("voucher_type"))
-					.where((se.docstatus == 1) & (se.posting_date <= self.to_date) & (se.is_opening == "Yes"))
-				)
-				+ (
-					frappe.qb.from_(sr)
-					.select(sr.name, Coalesce("Stock Reconciliation").as_("voucher_type"))
-					.where(
-						(sr.docstatus == 1) & (sr.posting_date <= self.to_date) & (sr.purpose == "Opening Stock")
-					)
-				)
-			).select("voucher_type", "name")
-		).run(as_dict=True)
-
-		if vouchers_data:
-			for d in vouchers_data:
-				opening_vouchers[d.voucher_type].append(d.name)
-
-		return opening_vouchers
-
 	@staticmethod
 	def get_inventory_dimension_fields():
 		return [dimension.fieldname for dimension in get_inventory_dimensions()]
@@ -589,42 +900,299 @@ class StockBalanceReport(object):
 		return opening_fifo_queue
 
 
+class ItemWarehouseMap:
+	"""
+	Balances of each group by key, stored column wise. A key gets an integer id which
+	indexes parallel arrays of the numeric fields and lists of the other fields, rows
+	are only built as dicts when read.
+	"""
+
+	NUMERIC_FIELDS = (
+		"opening_qty",
+		"opening_val",
+		"in_qty",
+		"in_val",
+		"out_qty",
+		"out_val",
+		"bal_qty",
+		"bal_val",
+		"val_rate",
+	)
+	DETAIL_FIELDS = (
+		"item_code",
+		"warehouse",
+		"item_group",
+		"company",
+		"stock_uom",
+		"item_name",
+		"opening_fifo_queue",
+	)
+
+	__slots__ = ("key_ids", "keys", "columns", "details", "currency", "precision")
+
+	def __init__(self, inventory_dimensions: List = None, currency: str = None, precision: int = None):
+		self.key_ids: Dict[tuple, int] = {}
+		self.keys: List[tuple] = []
+		self.columns = {fieldname: array("d") for fieldname in self.NUMERIC_FIELDS}
+		self.details = {
+			fieldname: [] for fieldname in self.DETAIL_FIELDS + tuple(inventory_dimensions or ())
+		}
+		self.currency = currency
+		self.precision = precision
+
+	def add(self, key: tuple, values: Dict) -> int:
+		"Add a key with `values` (missing numeric fields are 0) and return its id."
+		key_id = len(self.keys)
+		self.key_ids[key] = key_id
+		self.keys.append(key)
+
+		for fieldname, column in self.columns.items():
+			column.append(values.get(fieldname) or 0.0)
+
+		for fieldname, column in self.details.items():
+			column.append(values.get(fieldname))
+
+		return key_id
+
+	def get_no_transaction_mask(self, precision: int) -> List[bool]:
+		"True for each key id with every qty and value (not the rate) rounding to 0."
+		columns = [self.columns[fieldname] for fieldname in self.NUMERIC_FIELDS if fieldname != "val_rate"]
+		return [not any(round(value, precision) for value in values) for values in zip(*columns)]
+
+	def compress(self, mask: List[bool]) -> "ItemWarehouseMap":
+		"Returns a map without the key ids set in `mask`, ids are renumbered."
+		return self.take([key_id for key_id, drop in enumerate(mask) if not drop])
+
+	def sort(self) -> "ItemWarehouseMap":
+		"Returns a map with keys ordered by item code and warehouse, keys of a pair keep their order."
+		item_codes, warehouses = self.details["item_code"], self.details["warehouse"]
+		return self.take(
+			sorted(
+				range(len(self.keys)),
+				key=lambda key_id: (item_codes[key_id] or "", warehouses[key_id] or ""),
+			)
+		)
+
+	def take(self, keep: List[int]) -> "ItemWarehouseMap":
+		"Returns a map of the key ids in `keep`, in that order, ids are renumbered."
+		compressed = ItemWarehouseMap(currency=self.currency, precision=self.precision)
+
+		compressed.keys = [self.keys[key_id] for key_id in keep]
+		compressed.key_ids = {key: key_id for key_id, key in enumerate(compressed.keys)}
+		compressed.columns = {
+			fieldname: array("d", (column[key_id] for key_id in keep))
+			for fieldname, column in self.columns.items()
+		}
+		compressed.details = {
+			fieldname: [column[key_id] for key_id in keep] for fieldname, column in self.details.items()
+		}
+
+		return compressed
+
+	def get_row(self, key_id: int) -> frappe._dict:
+		row = frappe._dict({fieldname: column[key_id] for fieldname, column in self.details.items()})
+		row.currency = self.currency
+		for fieldname, column in self.columns.items():
+			row[fieldname] = flt(column[key_id], self.precision)
+
+		return row
+
+	def items(self):
+		for key_id, key in enumerate(self.keys):
+			yield key, self.get_row(key_id)
+
+	def __iter__(self):
+		return iter(self.keys)
+
+	def __len__(self):
+		return len(self.keys)
+
+	def __contains__(self, key):
+		return key in self.key_ids
+
+	def __getitem__(self, key) -> frappe._dict:
+		return self.get_row(self.key_ids[key])
+
+
 def filter_items_with_no_transactions(
-	iwb_map, float_precision: float, inventory_dimensions: list = None
-):
-	pop_keys = []
-	for group_by_key in iwb_map:
-		qty_dict = iwb_map[group_by_key]
+	iwb_map: ItemWarehouseMap, float_precision: float, inventory_dimensions: list = None
+) -> ItemWarehouseMap:
+	"Drop keys without opening, in, out or balance qty and value. Dimensions are not checked."
+	return iwb_map.compress(iwb_map.get_no_transaction_mask(float_precision))
 
-		no_transactions = True
-		for key, val in qty_dict.items():
-			if inventory_dimensions and key in inventory_dimensions:
-				continue
 
-			if key in [
-				"item_code",
-				"warehouse",
-				"item_name",
-				"item_group",
-				"project",
-				"stock_uom",
-				"company",
-				"opening_fifo_queue",
-			]:
-				continue
+def get_price_list_rate_cache_key(price_list: str) -> str:
+	return f"stock_balance_price_list_rates::{price_list}"
+
+
+def get_price_list_rate_generation_key(price_list: str) -> str:
+	return f"stock_balance_price_list_rates_generation::{price_list}"
+
+
+def get_price_list_rate_generation(price_list: str) -> str:
+	"Current generation of the cached rates of `price_list`, started if there is none."
+	cache = frappe.cache()
+	generation_key = get_price_list_rate_generation_key(price_list)
+
+	generation = cache.get_value(generation_key)
+	if not generation:
+		generation = frappe.generate_hash(length=10)
+		cache.set_value(generation_key, generation)
 
-			val = flt(val, float_precision)
-			qty_dict[key] = val
-			if key != "val_rate" and val:
-				no_transactions = False
+	return generation
 
-		if no_transactions:
-			pop_keys.append(group_by_key)
 
-	for key in pop_keys:
-		iwb_map.pop(key)
+def clear_price_list_rate_cache(doc, method=None):
+	"""
+	Item Price on_update (runs on insert too) and on_trash, starts a new generation of the
+	cached rates of its price list once the change is committed.
+	"""
+	price_lists = {doc.price_list}
+	if (doc_before_save := doc.get_doc_before_save()) and doc_before_save.price_list:
+		price_lists.add(doc_before_save.price_list)
 
-	return iwb_map
+	def start_generations():
+		for price_list in price_lists:
+			frappe.cache().set_value(
+				get_price_list_rate_generation_key(price_list), frappe.generate_hash(length=10)
+			)
+
+	frappe.db.after_commit.add(start_generations)
+
+
+def on_prepared_report_update(doc, method=None):
+	"Prepared Report on_update, stores the rows of a completed run for paging through them."
+	if doc.report_name != REPORT_NAME or doc.status != "Completed":
+		return
+
+	if frappe.db.exists("Stock Balance Report Row", {"prepared_report": doc.name}):
+		return
+
+	frappe.enqueue(
+		index_prepared_report,
+		queue="long",
+		prepared_report=doc.name,
+		enqueue_after_commit=True,
+	)
+
+
+def index_prepared_report(prepared_report: str):
+	"""
+	Store each row of a prepared report as a Stock Balance Report Row, with the fields
+	pages are sorted and filtered on as columns. The total row is not stored.
+	"""
+	if frappe.db.exists("Stock Balance Report Row", {"prepared_report": prepared_report}):
+		return
+
+	prepared_data = frappe.get_doc("Prepared Report", prepared_report).get_prepared_data() or {}
+
+	timestamp, user = now(), frappe.session.user
+	fields = (
+		"name",
+		"creation",
+		"modified",
+		"owner",
+		"modified_by",
+		"prepared_report",
+		"row_no",
+		*REPORT_ROW_FIELDS,
+		"row",
+	)
+
+	rows = []
+	for row_no, row in enumerate(prepared_data.get("result") or [], start=1):
+		if not isinstance(row, dict):
+			continue
+
+		rows.append(
+			(
+				frappe.generate_hash(length=10),
+				timestamp,
+				timestamp,
+				user,
+				user,
+				prepared_report,
+				row_no,
+				*(row.get(fieldname) for fieldname in REPORT_ROW_FIELDS),
+				json.dumps(row, default=str, separators=(",", ":")),
+			)
+		)
+
+	frappe.db.bulk_insert("Stock Balance Report Row", fields, rows, chunk_size=5000)
+
+
+def delete_prepared_report_rows(doc, method=None):
+	"Prepared Report on_trash."
+	frappe.db.delete("Stock Balance Report Row", {"prepared_report": doc.name})
+
+
+@frappe.whitelist()
+def get_prepared_report_page(
+	prepared_report: str,
+	start: int = 0,
+	page_length: int = MAX_PAGE_LENGTH,
+	sort_by: str = "row_no",
+	sort_order: str = "asc",
+	filter_field: str = None,
+	filter_operator: str = None,
+	filter_value: str = None,
+):
+	"""
+	Returns a page of the rows of a prepared run of the report, sorted on a column
+	and optionally filtered on one, without reading the whole prepared result.
+	Pages hold at most `MAX_PAGE_LENGTH` rows.
+	"""
+	doc = frappe.get_doc("Prepared Report", prepared_report)
+	doc.check_permission("read")
+
+	if doc.report_name != REPORT_NAME or not frappe.get_cached_doc("Report", REPORT_NAME).is_permitted():
+		frappe.throw(_("Not permitted to view {0}").format(prepared_report), frappe.PermissionError)
+
+	if sort_by not in SORT_FIELDS:
+		frappe.throw(_("Cannot sort on {0}").format(sort_by))
+
+	filters = {"prepared_report": prepared_report}
+	if filter_field:
+		if filter_field not in REPORT_ROW_FIELDS:
+			frappe.throw(_("Cannot filter on {0}").format(filter_field))
+
+		filter_operator = filter_operator or "like"
+		if filter_operator not in FILTER_OPERATORS:
+			frappe.throw(_("Invalid filter operator {0}").format(filter_operator))
+
+		if filter_operator == "like":
+			filter_value = f"%{filter_value}%"
+
+		filters[filter_field] = (filter_operator, filter_value)
+
+	rows = frappe.get_all(
+		"Stock Balance Report Row",
+		filters=filters,
+		pluck="row",
+		order_by=f"{sort_by} {'desc' if sort_order == 'desc' else 'asc'}, row_no asc",
+		limit_start=max(cint(start), 0),
+		limit_page_length=min(max(cint(page_length), 1), MAX_PAGE_LENGTH),
+	)
+
+	return {
+		"columns": get_prepared_report_columns(doc),
+		"data": [json.loads(row) for row in rows],
+		"total": frappe.db.count("Stock Balance Report Row", filters),
+		# rows are stored in the background once the run completes
+		"indexed": bool(rows or frappe.db.exists("Stock Balance Report Row", {"prepared_report": prepared_report})),
+	}
+
+
+def get_prepared_report_columns(prepared_report):
+	"Columns of a prepared run, built from its filters."
+	filters = frappe._dict(frappe.parse_json(prepared_report.filters) or {})
+	report = StockBalanceReport(filters)
+
+	columns = report.get_columns()
+	if filters.get("include_uom"):
+		add_additional_uom_columns(columns, [], filters.include_uom, {})
+
+	return columns
 
 
 def get_variants_attributes() -> List[str]:
@@ -0,0 +1,294 @@
+# Copyright (c) 2024, sushant and contributors
+# For license information, please see license.txt
+
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+from frappe.utils import flt, getdate
+
+from erpnext.stock.doctype.item.test_item import make_item
+from erpnext.stock.doctype.stock_entry.stock_entry_utils import make_stock_entry
+from erpnext.stock.doctype.stock_reconciliation.test_stock_reconciliation import (
+	create_stock_reconciliation,
+)
+
+from custom_stock_ageing_report.custom_stock_ageing_report.report.custom_stock_balance_with_price_list.custom_stock_balance_with_price_list import (
+	ItemWarehouseMap,
+	StockBalanceReport,
+	filter_items_with_no_transactions,
+)
+
+BALANCE_FIELDS = (
+	"opening_qty",
+	"opening_val",
+	"in_qty",
+	"in_val",
+	"out_qty",
+	"out_val",
+	"bal_qty",
+	"bal_val",
+)
+
+
+class TestCustomStockBalanceWithPriceList(FrappeTestCase):
+	def setUp(self):
+		self.item_code = make_item("_Test Stock Balance Item", {"is_stock_item": 1}).name
+		self.warehouse, self.target = "_Test Warehouse - _TC", "_Test Warehouse 1 - _TC"
+		self.filters = frappe._dict(
+			company="_Test Company",
+			from_date="2021-02-01",
+			to_date="2021-03-31",
+			item_code=self.item_code,
+			ignore_closing_balance=1,
+		)
+		self.make_ledger()
+
+	def tearDown(self):
+		frappe.db.rollback()
+
+	def make_ledger(self):
+		make_stock_entry(
+			item_code=self.item_code, target=self.warehouse, qty=5, rate=100, posting_date="2021-01-10"
+		)
+
+		opening = make_stock_entry(
+			item_code=self.item_code,
+			target=self.warehouse,
+			qty=10,
+			rate=100,
+			posting_date="2021-02-05",
+			do_not_save=True,
+		)
+		opening.is_opening = "Yes"
+		opening.items[0].expense_account = "Temporary Opening - _TC"
+		opening.insert()
+		opening.submit()
+
+		make_stock_entry(item_code=self.item_code, source=self.warehouse, qty=3, posting_date="2021-02-10")
+		create_stock_reconciliation(
+			item_code=self.item_code, warehouse=self.warehouse, qty=20, rate=110, posting_date="2021-02-20"
+		)
+		make_stock_entry(
+			item_code=self.item_code, target=self.warehouse, qty=4, rate=120, posting_date="2021-03-01"
+		)
+		create_stock_reconciliation(
+			item_code=self.item_code, warehouse=self.warehouse, qty=10, rate=120, posting_date="2021-03-10"
+		)
+		make_stock_entry(
+			item_code=self.item_code,
+			source=self.warehouse,
+			target=self.target,
+			qty=3,
+			posting_date="2021-03-15",
+		)
+
+	def get_balances(self, filters):
+		_columns, data = StockBalanceReport(frappe._dict(filters)).run()
+		return {
+			(row.item_code, row.warehouse): {fieldname: row[fieldname] for fieldname in BALANCE_FIELDS}
+			for row in data
+		}
+
+	def get_ledger_row_balances(self, filters):
+		"""
+		Balances as the report computed them before totalling in SQL, one ledger row at a time.
+		Stock Reconciliation qty is the change from the running balance of the key.
+		"""
+		report = StockBalanceReport(frappe._dict(filters))
+		report.float_precision = 3
+		report.inventory_dimensions = report.get_inventory_dimension_fields()
+		report.prepare_opening_data_from_closing_balance()
+		report.prepare_stock_ledger_entries()
+
+		opening_vouchers = set(
+			frappe.get_all("Stock Entry", {"is_opening": "Yes", "docstatus": 1}, pluck="name")
+			+ frappe.get_all("Stock Reconciliation", {"purpose": "Opening Stock", "docstatus": 1}, pluck="name")
+		)
+
+		balances = {}
+		for entry in report.sle_entries:
+			key = (entry.item_code, entry.warehouse)
+			if key not in balances:
+				opening_data = report.opening_data.get(report.get_group_by_key(entry)) or {}
+				balances[key] = frappe._dict.fromkeys(BALANCE_FIELDS, 0.0)
+				for fieldname in ("opening_qty", "bal_qty"):
+					balances[key][fieldname] = flt(opening_data.get("bal_qty"))
+				for fieldname in ("opening_val", "bal_val"):
+					balances[key][fieldname] = flt(opening_data.get("bal_val"))
+
+			qty_dict = balances[key]
+			if entry.voucher_type == "Stock Reconciliation" and (not entry.batch_no or entry.serial_no):
+				qty_diff = flt(entry.qty_after_transaction) - flt(qty_dict.bal_qty)
+			else:
+				qty_diff = flt(entry.actual_qty)
+
+			value_diff = flt(entry.stock_value_difference)
+			if entry.posting_date < report.from_date or entry.voucher_no in opening_vouchers:
+				qty_dict.opening_qty += qty_diff
+				qty_dict.opening_val += value_diff
+			elif flt(qty_diff, 3) >= 0:
+				qty_dict.in_qty += qty_diff
+				qty_dict.in_val += value_diff
+			else:
+				qty_dict.out_qty += abs(qty_diff)
+				qty_dict.out_val += abs(value_diff)
+
+			qty_dict.bal_qty += qty_diff
+			qty_dict.bal_val += value_diff
+
+		return {
+			key: {fieldname: flt(value, 3) for fieldname, value in qty_dict.items()}
+			for key, qty_dict in balances.items()
+		}
+
+	def test_totals_match_ledger_row_balances(self):
+		"Opening vouchers, entries before the from date and Stock Reconciliation."
+		balances = self.get_balances(self.filters)
+
+		self.assertEqual(balances, self.get_ledger_row_balances(self.filters))
+		self.assertEqual(balances[(self.item_code, self.warehouse)]["opening_qty"], 15.0)
+		self.assertEqual(balances[(self.item_code, self.warehouse)]["bal_qty"], 7.0)
+		self.assertEqual(balances[(self.item_code, self.target)]["in_qty"], 3.0)
+
+	def test_totals_from_closing_balance_match_ledger_row_balances(self):
+		"The ledger scan starts after the closing, the first Stock Reconciliation follows its balance."
+		closing_date = getdate("2021-02-14")
+		item_details = frappe.db.get_value(
+			"Item", self.item_code, ["item_group", "item_name", "stock_uom"], as_dict=True
+		)
+		closing_entries = {}
+		for entry in frappe.get_all(
+			"Stock Ledger Entry",
+			filters={"item_code": self.item_code, "is_cancelled": 0, "posting_date": ("<=", closing_date)},
+			fields=[
+				"company",
+				"item_code",
+				"warehouse",
+				"qty_after_transaction as bal_qty",
+				"stock_value as bal_val",
+			],
+			order_by="posting_date, posting_time, creation",
+		):
+			entry.update(item_details)
+			entry.fifo_queue = []
+			closing_entries[(entry.item_code, entry.warehouse)] = entry
+
+		filters = frappe._dict(self.filters, from_date="2021-03-01", ignore_closing_balance=0)
+		with patch.object(
+			StockBalanceReport,
+			"get_closing_balance",
+			return_value=[frappe._dict(name="_Test Closing Stock Balance", to_date=closing_date)],
+		), patch.object(
+			StockBalanceReport,
+			"get_closing_balance_entries",
+			side_effect=lambda *args: [frappe._dict(d) for d in closing_entries.values()],
+		):
+			balances = self.get_balances(filters)
+			ledger_row_balances = self.get_ledger_row_balances(filters)
+
+		self.assertEqual(balances, ledger_row_balances)
+		self.assertEqual(balances[(self.item_code, self.warehouse)]["opening_qty"], 20.0)
+		self.assertEqual(balances[(self.item_code, self.warehouse)]["bal_qty"], 7.0)
+
+
+class TestItemWarehouseMap(FrappeTestCase):
+	def get_dict_map(self, balances, float_precision):
+		"Map as kept before it was stored column wise, one dict per key."
+		iwb_map = {key: frappe._dict(values) for key, values in balances.items()}
+		detail_fields = set(ItemWarehouseMap.DETAIL_FIELDS) | {"project"}
+
+		pop_keys = []
+		for group_by_key, qty_dict in iwb_map.items():
+			no_transactions = True
+			for key, val in qty_dict.items():
+				if key in detail_fields:
+					continue
+
+				val = flt(val, float_precision)
+				qty_dict[key] = val
+				if key != "val_rate" and val:
+					no_transactions = False
+
+			if no_transactions:
+				pop_keys.append(group_by_key)
+
+		for key in pop_keys:
+			iwb_map.pop(key)
+
+		return iwb_map
+
+	def test_columns_match_dict_map(self):
+		"Keys kept and rows read back are the same as with a dict per key."
+
+		def balance(item_code, project=None, **values):
+			row = {fieldname: 0.0 for fieldname in ItemWarehouseMap.NUMERIC_FIELDS}
+			row.update(
+				item_code=item_code,
+				warehouse="_Test Warehouse - _TC",
+				item_group="_Test Item Group",
+				company="_Test Company",
+				stock_uom="Nos",
+				item_name=item_code,
+				opening_fifo_queue=[],
+				project=project,
+			)
+			row.update(values)
+			return ("_Test Company", item_code, "_Test Warehouse - _TC"), row
+
+		balances = dict(
+			[
+				balance("Moved", opening_qty=5, opening_val=500, out_qty=5, out_val=500, val_rate=100),
+				balance("Rate Only", val_rate=100),
+				balance("Rounds To Zero", in_qty=0.0004, bal_qty=0.0004),
+				balance("Value Only", in_val=10.0, bal_val=10.0),
+				balance("Opening Only", opening_qty=2, opening_val=20.125, bal_qty=2, bal_val=20.125),
+				balance("Negative", out_qty=3, out_val=30, bal_qty=-3, bal_val=-30, val_rate=10),
+				balance("Project Only", project="_Test Project"),
+				balance("Untouched"),
+			]
+		)
+
+		iwb_map = ItemWarehouseMap(["project"], "INR", 3)
+		for key, values in balances.items():
+			iwb_map.add(key, values)
+
+		iwb_map = filter_items_with_no_transactions(iwb_map, 3, ["project"])
+		dict_map = self.get_dict_map(balances, 3)
+
+		self.assertEqual(list(iwb_map), list(dict_map))
+		for key, row in iwb_map.items():
+			self.assertEqual(row.pop("currency"), "INR")
+			self.assertEqual(row, dict_map[key])
+
+		self.assertEqual(
+			[key[1] for key in iwb_map], ["Moved", "Value Only", "Opening Only", "Negative"]
+		)
+
+	def test_ageing_page_follows_row_order(self):
+		"Keys are sorted by item and warehouse with their columns, ageing pages are taken in that order."
+		iwb_map = ItemWarehouseMap(currency="INR", precision=3)
+		for bal_qty, (item_code, warehouse) in enumerate(
+			[("Item B", "WH 2"), ("Item A", "WH 2"), ("Item B", "WH 1"), ("Item A", "WH 1")], 1
+		):
+			iwb_map.add(
+				("_Test Company", item_code, warehouse),
+				{"item_code": item_code, "warehouse": warehouse, "bal_qty": bal_qty},
+			)
+
+		iwb_map = iwb_map.sort()
+		self.assertEqual(
+			[(key[1], key[2], row.bal_qty) for key, row in iwb_map.items()],
+			[("Item A", "WH 1", 4.0), ("Item A", "WH 2", 2.0), ("Item B", "WH 1", 3.0), ("Item B", "WH 2", 1.0)],
+		)
+
+		report = StockBalanceReport(
+			frappe._dict(
+				from_date="2021-01-01", to_date="2021-01-31", ageing_page_start=1, ageing_page_length=2
+			)
+		)
+		report.item_warehouse_map = iwb_map
+		self.assertEqual(
+			report.get_ageing_keys(),
+			{("_Test Company", "Item A", "WH 2"), ("_Test Company", "Item B", "WH 1")},
+		)
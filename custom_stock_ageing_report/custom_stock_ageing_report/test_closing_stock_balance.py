@@ -0,0 +1,57 @@
+# Copyright (c) 2024, sushant and contributors
+# For license information, please see license.txt
+
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+from frappe.utils import getdate
+
+from erpnext.stock.doctype.item.test_item import make_item
+from erpnext.stock.doctype.stock_entry.stock_entry_utils import make_stock_entry
+
+from custom_stock_ageing_report.custom_stock_ageing_report.closing_stock_balance import (
+	create_closing_stock_balance,
+	get_company_closing_filters,
+	get_unclosed_month_ends,
+)
+
+
+class TestClosingStockBalance(FrappeTestCase):
+	def setUp(self):
+		self.company, self.month_end = "_Test Company", getdate("2021-01-31")
+		item_code = make_item("_Test Closing Balance Item", {"is_stock_item": 1}).name
+		make_stock_entry(
+			item_code=item_code, target="_Test Warehouse - _TC", qty=5, rate=100, posting_date="2021-01-10"
+		)
+
+		# preparation of the balances is queued after commit, it does not run here
+		enqueue = patch.object(frappe, "enqueue")
+		enqueue.start()
+		self.addCleanup(enqueue.stop)
+
+	def tearDown(self):
+		frappe.db.rollback()
+
+	def get_month_closings(self):
+		filters = get_company_closing_filters(self.company)
+		filters.update({"to_date": self.month_end, "docstatus": ("!=", 0)})
+		return frappe.get_all("Closing Stock Balance", filters=filters, fields=["name", "docstatus"])
+
+	def test_failed_closing_is_closed_again(self):
+		"A Failed closing counts as unclosed and is cancelled when the month is closed again."
+		create_closing_stock_balance(self.company, self.month_end)
+		(failed,) = [d.name for d in self.get_month_closings() if d.docstatus == 1]
+
+		frappe.db.set_value("Closing Stock Balance", failed, "status", "Completed")
+		self.assertNotIn(self.month_end, get_unclosed_month_ends(self.company))
+
+		frappe.db.set_value("Closing Stock Balance", failed, "status", "Failed")
+		self.assertIn(self.month_end, get_unclosed_month_ends(self.company))
+
+		create_closing_stock_balance(self.company, self.month_end)
+		closings = self.get_month_closings()
+
+		self.assertEqual(frappe.db.get_value("Closing Stock Balance", failed, "docstatus"), 2)
+		self.assertEqual(len([d for d in closings if d.docstatus == 1]), 1)
+		self.assertNotIn(failed, [d.name for d in closings if d.docstatus == 1])
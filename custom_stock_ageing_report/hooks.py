@@ -131,6 +131,47 @@ app_license = "MIT"
 #	],
 # }
 
+doc_events = {
+	"*": {
+		"on_cancel": [
+			"custom_stock_ageing_report.custom_stock_ageing_report.doctype.stock_ageing_checkpoint.stock_ageing_checkpoint.on_cancel",
+			"custom_stock_ageing_report.custom_stock_ageing_report.closing_stock_balance.on_cancel",
+		]
+	},
+	"Stock Ledger Entry": {
+		"on_submit": [
+			"custom_stock_ageing_report.custom_stock_ageing_report.doctype.stock_ageing_checkpoint.stock_ageing_checkpoint.on_stock_ledger_entry_submit",
+			"custom_stock_ageing_report.custom_stock_ageing_report.closing_stock_balance.on_stock_ledger_entry_submit",
+		]
+	},
+	"Item Price": {
+		"on_update": "custom_stock_ageing_report.custom_stock_ageing_report.report.custom_stock_balance_with_price_list.custom_stock_balance_with_price_list.clear_price_list_rate_cache",
+		"on_trash": "custom_stock_ageing_report.custom_stock_ageing_report.report.custom_stock_balance_with_price_list.custom_stock_balance_with_price_list.clear_price_list_rate_cache",
+	},
+	"Closing Stock Balance": {
+		"on_cancel": "custom_stock_ageing_report.custom_stock_ageing_report.doctype.closing_stock_balance_entry.closing_stock_balance_entry.delete_closing_stock_balance_entries",
+		"on_trash": "custom_stock_ageing_report.custom_stock_ageing_report.doctype.closing_stock_balance_entry.closing_stock_balance_entry.delete_closing_stock_balance_entries",
+	},
+	"Prepared Report": {
+		"on_update": "custom_stock_ageing_report.custom_stock_ageing_report.report.custom_stock_balance_with_price_list.custom_stock_balance_with_price_list.on_prepared_report_update",
+		"on_trash": "custom_stock_ageing_report.custom_stock_ageing_report.report.custom_stock_balance_with_price_list.custom_stock_balance_with_price_list.delete_prepared_report_rows",
+	},
+	"Repost Item Valuation": {
+		"on_submit": [
+			"custom_stock_ageing_report.custom_stock_ageing_report.doctype.stock_ageing_checkpoint.stock_ageing_checkpoint.on_repost_item_valuation_submit",
+			"custom_stock_ageing_report.custom_stock_ageing_report.closing_stock_balance.on_repost_item_valuation_submit",
+		]
+	},
+}
+
+scheduler_events = {
+	"daily_long": [
+		"custom_stock_ageing_report.custom_stock_ageing_report.doctype.stock_ageing_checkpoint.stock_ageing_checkpoint.create_stock_ageing_checkpoints",
+		"custom_stock_ageing_report.custom_stock_ageing_report.doctype.stock_ageing_snapshot.stock_ageing_snapshot.create_stock_ageing_snapshots",
+		"custom_stock_ageing_report.custom_stock_ageing_report.closing_stock_balance.create_monthly_closing_stock_balances",
+	],
+}
+
 # Testing
 # -------
 